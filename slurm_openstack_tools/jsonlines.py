@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Buffered JSON-lines output for slurm-stats.
+
+Records are encoded exactly as `json.dumps(record)` would, one per line,
+and collected into large chunks so each chunk is a single write. If the
+optional `ujson` package is installed and encodes a test record exactly as
+the stdlib does, it is used to encode job records, as it is about twice as
+fast. Otherwise the stdlib encoder is used.
+
+Output goes to stdout, or appended to a file that may be gzip or zstd
+compressed (zstd needs the optional `zstandard` package) and is rotated
+by size. Each run adds a new gzip member or zstd frame, which zcat and
+zstdcat read as one stream.
+"""
+
+import collections
+import gzip
+import json
+import os
+import sys
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Characters encoded before each chunk is written out
+BUFFER_SIZE = 1 << 20
+
+COMPRESSORS = ("gzip", "zstd")
+DEFAULT_BACKUP_COUNT = 5
+
+# A job-like record a fast encoder must encode byte-for-byte as json.dumps
+# does before it is used. ujson formats floats differently, so records with
+# floats (e.g. occupancy) should ask for the "json" encoder.
+_CHECK_RECORD = {
+    "JobID": "1_[2-3%4]", "GID": 1000, "Epoch": 1592916201000,
+    "Big": 2 ** 63 + 1, "Negative": -1, "Path": "/home/user/run.sh",
+    "Escapes": "\"quoted\" back\\slash\ttab\nnewline\x01\x7f",
+    "Unicode": "café   \U0001f600", "Empty": "",
+    "AllNodes": ["c1", "c2"], "Nested": {"a": [], "b": {}},
+}
+
+
+def _json_encoder():
+    return json.JSONEncoder().encode
+
+
+def _ujson_encoder():
+    if ujson is None:
+        return None
+
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=True,
+                           escape_forward_slashes=False,
+                           separators=(", ", ": "))
+    return encode
+
+
+# Encoders in order of preference
+ENCODERS = collections.OrderedDict([
+    ("ujson", _ujson_encoder),
+    ("json", _json_encoder),
+])
+
+
+def get_encoder(name=None):
+    """Return a function encoding an object as json.dumps() would.
+
+    name picks one of ENCODERS. By default the first available encoder that
+    matches json.dumps() on a test record is used.
+    """
+    if name:
+        encode = ENCODERS[name]()
+        if encode is None:
+            raise RuntimeError(f"JSON encoder {name} is not installed")
+        return encode
+    expected = json.dumps(_CHECK_RECORD)
+    for factory in ENCODERS.values():
+        encode = factory()
+        try:
+            if encode is not None and encode(_CHECK_RECORD) == expected:
+                return encode
+        except (TypeError, ValueError):
+            # e.g. an old ujson without separators
+            pass
+    return _json_encoder()
+
+
+class RotatingFile(object):
+    """A text file appended to, optionally compressed and rotated by size.
+
+    Once the file on disk is larger than max_bytes after a write it is
+    renamed to path.1 (path.1 to path.2, and so on, keeping backup_count
+    old files) and a new file started. max_bytes of 0 never rotates.
+    Writer writes whole chunks, so with rotation each chunk is flushed to
+    check the size.
+    """
+
+    def __init__(self, path, compress=None, max_bytes=0,
+                 backup_count=DEFAULT_BACKUP_COUNT):
+        if compress not in (None,) + COMPRESSORS:
+            raise ValueError(f"Unknown compression {compress}")
+        if compress == "zstd" and zstandard is None:
+            raise RuntimeError(
+                "zstd output needs the zstandard package: "
+                "pip install slurm-openstack-tools[zstd]")
+        self.path = path
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._open()
+
+    def _open(self):
+        self._raw = open(self.path, "ab")
+        if self.compress == "gzip":
+            self._file = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        elif self.compress == "zstd":
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._file = self._raw
+
+    def _close(self):
+        self._file.close()
+        self._raw.close()
+
+    def _rotate(self):
+        self._close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, text):
+        self._file.write(text.encode("utf-8"))
+        if self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._raw.flush()
+        if self.max_bytes and os.fstat(
+                self._raw.fileno()).st_size > self.max_bytes:
+            self._rotate()
+
+    def close(self):
+        self._close()
+
+
+class Writer(object):
+    """Write records as JSON lines to a text stream in large chunks.
+
+    Records are held until BUFFER_SIZE characters are waiting or flush() is
+    called. Used as a context manager, the writer is flushed on exit and
+    closes the stream if close_stream is set.
+    """
+
+    def __init__(self, stream, encoder=None, buffer_size=BUFFER_SIZE,
+                 close_stream=False):
+        self.stream = stream
+        self.encode = encoder or get_encoder()
+        self.buffer_size = buffer_size
+        self.close_stream = close_stream
+        self._lines = []
+        self._size = 0
+
+    def write(self, record):
+        line = self.encode(record)
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size >= self.buffer_size:
+            self._write_lines()
+
+    def _write_lines(self):
+        if self._lines:
+            self._lines.append("")
+            self.stream.write("\n".join(self._lines))
+            self._lines = []
+            self._size = 0
+
+    def flush(self):
+        self._write_lines()
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+def open_output(path=None, compress=None, max_bytes=0,
+                backup_count=DEFAULT_BACKUP_COUNT, encoder=None):
+    """Return a Writer to a RotatingFile at path, or to stdout."""
+    if path is None:
+        if compress:
+            raise ValueError("Compressed output needs a file path")
+        return Writer(sys.stdout, encoder)
+    return Writer(RotatingFile(path, compress, max_bytes, backup_count),
+                  encoder, close_stream=True)
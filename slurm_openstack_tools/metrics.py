@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Latency and error metrics for OpenStack API calls and Slurm commands.
+
+Set SLURM_OPENSTACK_METRICS_DIR to a node-exporter textfile collector
+directory (e.g. /var/lib/node_exporter/textfile_collector) and each tool
+adds its samples to `slurm_openstack_<tool>.prom` there when it exits:
+
+    slurm_openstack_api_call_duration_seconds  histogram
+    slurm_openstack_api_calls_total            counter
+    slurm_openstack_command_duration_seconds   histogram
+    slurm_openstack_commands_total             counter
+
+labelled by tool, operation, partition and (for the counters) result.
+Samples from earlier invocations are read back and added to, so counters
+keep increasing across runs. Without the environment variable nothing is
+written.
+"""
+
+import atexit
+import contextlib
+import fcntl
+import os
+import re
+import subprocess
+import threading
+import time
+
+from slurm_openstack_tools import tracing
+
+METRICS_DIR_ENV = "SLURM_OPENSTACK_METRICS_DIR"
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+           60.0, 120.0, float("inf"))
+
+FAMILIES = {
+    "slurm_openstack_api_call_duration_seconds": (
+        "histogram", "Duration of OpenStack API calls"),
+    "slurm_openstack_api_calls_total": (
+        "counter", "OpenStack API calls by result"),
+    "slurm_openstack_command_duration_seconds": (
+        "histogram", "Duration of Slurm command invocations"),
+    "slurm_openstack_commands_total": (
+        "counter", "Slurm command invocations by result"),
+}
+
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+LE_RE = re.compile(r',le="([^"]*)"\}$')
+
+_samples = {}
+_lock = threading.Lock()
+_local = threading.local()
+_tool = "unknown"
+
+
+def configure(tool):
+    """Set the tool label and write metrics at exit if enabled."""
+    global _tool
+    _tool = tool
+    if os.environ.get(METRICS_DIR_ENV):
+        atexit.register(write)
+
+
+@contextlib.contextmanager
+def partition(name):
+    """Label metrics recorded in this thread with a Slurm partition."""
+    previous = getattr(_local, "partition", "")
+    _local.partition = name or ""
+    try:
+        yield
+    finally:
+        _local.partition = previous
+
+
+def _format_labels(labels):
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels)
+
+
+def _observe(kind, operation, seconds, ok):
+    labels = [("tool", _tool), ("operation", operation),
+              ("partition", getattr(_local, "partition", ""))]
+    prefix = "slurm_openstack_%s" % kind
+    with _lock:
+        # Every bucket is written, even if empty, so each series has the
+        # same buckets in every scrape
+        for bound in BUCKETS:
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            key = ("%s_duration_seconds_bucket" % prefix,
+                   _format_labels(labels + [("le", le)]))
+            _samples[key] = _samples.get(key, 0) + (seconds <= bound)
+        for suffix, value in (("sum", seconds), ("count", 1)):
+            key = ("%s_duration_seconds_%s" % (prefix, suffix),
+                   _format_labels(labels))
+            _samples[key] = _samples.get(key, 0) + value
+        key = ("%ss_total" % prefix, _format_labels(
+            labels + [("result", "success" if ok else "error")]))
+        _samples[key] = _samples.get(key, 0) + 1
+
+
+def observe_api_call(operation, seconds, ok):
+    _observe("api_call", operation, seconds, ok)
+
+
+def observe_command(operation, seconds, ok):
+    _observe("command", operation, seconds, ok)
+
+
+def run(args, **kwargs):
+    """subprocess.run() recording the command's latency and exit status.
+
+    The operation label is the command and its subcommand, e.g.
+    "scontrol show" or "sacct".
+    """
+    operation = " ".join(a for a in args[:2] if not a.startswith("-"))
+    started = time.monotonic()
+    ok = False
+    try:
+        with tracing.span(operation, kind="command") as command_span:
+            result = subprocess.run(args, **kwargs)
+            command_span.set("returncode", result.returncode)
+        ok = result.returncode == 0
+        return result
+    finally:
+        observe_command(operation, time.monotonic() - started, ok)
+
+
+def read_samples(path):
+    """Parse the samples from a textfile written by write()."""
+    samples = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                match = SAMPLE_RE.match(line.strip())
+                if match:
+                    name, labels, value = match.groups()
+                    samples[(name, labels or "")] = float(value)
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def _sort_key(item):
+    """Order samples by name and labels, with buckets in numeric order."""
+    (name, labels), _ = item
+    match = LE_RE.search(labels)
+    if match is None:
+        return name, labels, 0.0
+    return name, labels[:match.start()], float(match.group(1))
+
+
+def render(samples):
+    """Return samples in the Prometheus text exposition format."""
+    lines = []
+    for family, (kind, description) in sorted(FAMILIES.items()):
+        family_samples = sorted(
+            ((key, value) for key, value in samples.items()
+             if key[0] == family or (kind == "histogram" and key[0] in (
+                 family + "_bucket", family + "_sum", family + "_count"))),
+            key=_sort_key)
+        if not family_samples:
+            continue
+        lines.append("# HELP %s %s" % (family, description))
+        lines.append("# TYPE %s %s" % (family, kind))
+        for (name, labels), value in family_samples:
+            lines.append("%s%s %s" % (name, labels, repr(float(value))))
+    return "".join(line + "\n" for line in lines)
+
+
+def write(directory=None):
+    """Add this process's samples to the tool's textfile atomically."""
+    directory = directory or os.environ.get(METRICS_DIR_ENV)
+    with _lock:
+        samples = dict(_samples)
+        _samples.clear()
+    if not directory or not samples:
+        return
+    path = os.path.join(directory, "slurm_openstack_%s.prom" % _tool)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = read_samples(path)
+        for key, value in samples.items():
+            merged[key] = merged.get(key, 0) + value
+        tmp_path = "%s.tmp.%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(render(merged))
+        os.replace(tmp_path, path)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Per-node and per-partition occupancy timelines from slurm-stats jobs.
+
+The time range is split into fixed-resolution bins. For every node the
+union of its jobs' [StartEpoch, EndEpoch) intervals is computed, so
+overlapping jobs on a shared node are not double counted. The result is the
+fraction of each bin the node was busy. Partition timelines are the mean
+over the nodes seen running jobs in that partition.
+
+All the interval arithmetic is vectorised with NumPy: every node's
+intervals are laid end to end on one global axis and merged in a single
+sort. Busy time per bin is then read off a cumulative busy-time function
+evaluated at the bin edges, a block of nodes at a time to bound the memory
+used. Requires the optional `numpy` dependency
+(`pip install slurm-openstack-tools[occupancy]`).
+"""
+
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Nodes whose bin edges are evaluated at once; each needs a few int64
+# arrays of (bins + 1) entries
+CHUNK_NODES = 256
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError(
+            "NumPy is required for occupancy timelines: "
+            "pip install slurm-openstack-tools[occupancy]")
+
+
+def intervals(items):
+    """Return the nodes, partitions and busy intervals in job items.
+
+    Returns (nodes, node_partitions, node_index, starts, ends) where the last
+    three are arrays with one entry per (job, node) pair, in epoch ms.
+    """
+    _require_numpy()
+    nodes = {}
+    node_partitions = collections.defaultdict(set)
+    counts, starts, ends, index = [], [], [], []
+    for item in items:
+        job_nodes = item.get("AllNodes")
+        start = item.get("StartEpoch")
+        end = item.get("EndEpoch")
+        if not job_nodes or start is None or end is None or end <= start:
+            continue
+        partition = item.get("Partition")
+        for node in job_nodes:
+            index.append(nodes.setdefault(node, len(nodes)))
+            if partition:
+                node_partitions[node].add(partition)
+        counts.append(len(job_nodes))
+        starts.append(start)
+        ends.append(end)
+    return (list(nodes), node_partitions,
+            np.array(index, dtype=np.int64),
+            np.repeat(np.array(starts, dtype=np.int64), counts),
+            np.repeat(np.array(ends, dtype=np.int64), counts))
+
+
+def busy_fraction(node_index, starts, ends, node_count, start, end,
+                  resolution):
+    """Return a (node_count, bins) array of the fraction of each bin busy.
+
+    start and end bound the timeline in epoch ms; resolution is the bin
+    width in ms. Bins run from start; the last bin may extend past end.
+    """
+    _require_numpy()
+    bins = max(1, -(-(end - start) // resolution))
+    span = bins * resolution
+    # Lay each node's clipped intervals end to end on one axis, with a gap
+    # between nodes so intervals never merge across them
+    stride = span + resolution
+    s = np.clip(starts, start, start + span) - start
+    e = np.clip(ends, start, start + span) - start
+    keep = e > s
+    offset = node_index[keep] * stride
+    s = s[keep] + offset
+    e = e[keep] + offset
+
+    if not len(s):
+        return np.zeros((node_count, bins))
+
+    # Merge overlapping intervals: sort by start, and begin a new merged
+    # interval wherever a start is past every earlier end
+    order = np.argsort(s, kind="stable")
+    s = s[order]
+    reach = np.maximum.accumulate(e[order])
+    first = np.ones(len(s), dtype=bool)
+    first[1:] = s[1:] > reach[:-1]
+    merged_starts = s[first]
+    last = np.flatnonzero(np.r_[first[1:], True])
+    merged_lengths = reach[last] - merged_starts
+    busy_before = np.r_[0, np.cumsum(merged_lengths)]
+
+    # Cumulative busy time at every bin edge of every node: everything in
+    # earlier merged intervals, plus however far into the current one
+    busy = np.empty((node_count, bins))
+    bin_edges = np.arange(bins + 1, dtype=np.int64) * resolution
+    for first_node in range(0, node_count, CHUNK_NODES):
+        chunk = slice(first_node, min(first_node + CHUNK_NODES, node_count))
+        node_offsets = np.arange(
+            chunk.start, chunk.stop, dtype=np.int64)[:, None] * stride
+        edges = node_offsets + bin_edges
+        k = np.searchsorted(merged_starts, edges, side="right") - 1
+        current = np.maximum(k, 0)
+        cumulative = np.where(
+            k >= 0,
+            busy_before[current] + np.clip(
+                edges - merged_starts[current], 0, merged_lengths[current]),
+            0)
+        busy[chunk] = np.diff(cumulative, axis=1) / resolution
+    return busy
+
+
+def timelines(items, start, end, resolution):
+    """Compute per-node and per-partition occupancy for job items.
+
+    start and end are epoch ms, resolution is the bin width in seconds.
+    Returns (node_timelines, partition_timelines): dicts mapping names to
+    arrays of busy fractions per bin.
+    """
+    nodes, node_partitions, node_index, starts, ends = intervals(items)
+    busy = busy_fraction(node_index, starts, ends, len(nodes), start, end,
+                         resolution * 1000)
+    node_timelines = dict(zip(nodes, busy))
+    members = collections.defaultdict(list)
+    for i, node in enumerate(nodes):
+        for partition in node_partitions[node]:
+            members[partition].append(i)
+    partition_timelines = {
+        partition: busy[rows].mean(axis=0)
+        for partition, rows in members.items()}
+    return node_timelines, partition_timelines
+
+
+def records(items, start, end, resolution):
+    """Yield JSON-ready occupancy records for nodes, then partitions."""
+    node_timelines, partition_timelines = timelines(
+        items, start, end, resolution)
+    for kind, series in (("Node", node_timelines),
+                         ("Partition", partition_timelines)):
+        for name in sorted(series):
+            utilisation = series[name]
+            yield {
+                kind: name,
+                "StartEpoch": start,
+                "Resolution": resolution,
+                "MeanUtilisation": round(float(utilisation.mean()), 4),
+                "Utilisation": np.round(utilisation, 4).tolist(),
+            }
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Power up cloud nodes ahead of the jobs waiting for them.
+
+Usage:
+
+    preresume [--interval SECONDS] [--max-nodes N] [--max-powering N]
+        [--partitions PARTITION,...] [--once] [--dry-run]
+
+Every interval, pending jobs are read from squeue (highest priority first)
+and nodes from sinfo. Each job is matched against idle powered-up nodes, and
+nodes already powering up, in its partitions with the features it requires.
+Where those are not enough, powered-down idle nodes are powered up with
+`scontrol update nodename=<hostlist> state=power_up`. slurmctld then runs
+its ResumeProgram (slurm-openstack-resume) for them as usual, so the nodes
+are created exactly as they would be for a scheduled job.
+
+At most --max-nodes are powered up per interval, and none while
+--max-powering nodes are already powering up. Jobs which could not get all
+the nodes they need are skipped. Constraints other than a plain list of
+features joined with "&" are ignored, and any node in the job's partitions
+is assumed to match.
+
+Output and exceptions are written to the syslog.
+"""
+
+import argparse
+import logging.handlers
+import subprocess
+import sys
+import time
+
+from ClusterShell import NodeSet
+
+from slurm_openstack_tools import metrics
+from slurm_openstack_tools import tracing
+
+DEFAULT_INTERVAL = 30
+DEFAULT_MAX_NODES = 10
+DEFAULT_MAX_POWERING = 50
+
+# Pending reasons meaning a job is only waiting for nodes, e.g. not held or
+# waiting on a dependency
+WAITING_REASONS = ('None', 'Priority', 'Resources')
+
+# configure logging to syslog - by default only "info" and above
+# categories appear
+logger = logging.getLogger("syslogger")
+logger.setLevel(logging.DEBUG)
+handler = logging.handlers.SysLogHandler("/dev/log")
+handler.setFormatter(logging.Formatter(sys.argv[0] + ': %(message)s'))
+logger.addHandler(handler)
+
+
+def parse_constraint(constraint):
+    """Return the set of features a job constraint requires.
+
+    Returns None if the constraint is more than features joined with "&".
+    """
+    if constraint in ('', '(null)'):
+        return set()
+    if any(c in constraint for c in '|[]()*,:'):
+        return None
+    return set(constraint.split('&'))
+
+
+def get_pending_jobs():
+    """Return pending jobs waiting for nodes, highest priority first.
+
+    Each job is a dict with its id, partitions, required features (see
+    parse_constraint) and number of nodes.
+    """
+    squeue = metrics.run(
+        ['squeue', '--noheader', '--states=PENDING', '--sort=-p,i',
+         '--format=%i|%P|%f|%D|%r'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    jobs = []
+    for line in squeue.stdout.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) != 5 or fields[4] not in WAITING_REASONS:
+            continue
+        job_id, partitions, constraint, nodes, _ = fields
+        try:
+            nodes = int(nodes)
+        except ValueError:
+            nodes = 1
+        jobs.append({
+            'id': job_id,
+            'partitions': set(partitions.split(',')),
+            'features': parse_constraint(constraint),
+            'nodes': nodes,
+        })
+    return jobs
+
+
+def get_nodes():
+    """Return a dict of nodes' partitions, features and compact state."""
+    sinfo = metrics.run(
+        ['sinfo', '--noheader', '--Node', '--format=%N|%P|%f|%t'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    nodes = {}
+    for line in sinfo.stdout.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) != 4:
+            continue
+        name, partition, features, state = fields
+        # sinfo lists a node once per partition
+        node = nodes.setdefault(name, {
+            'partitions': set(),
+            'features': set(features.split(',')) - {'(null)'},
+            'state': state,
+        })
+        node['partitions'].add(partition.rstrip('*'))
+    return nodes
+
+
+def _matches(node, partitions, features):
+    if not node['partitions'] & partitions:
+        return False
+    return features is None or features <= node['features']
+
+
+def plan(jobs, nodes, max_nodes=DEFAULT_MAX_NODES,
+         max_powering=DEFAULT_MAX_POWERING, partitions=None):
+    """Return the names of powered-down nodes to power up for jobs.
+
+    Nodes are assigned to jobs in order: first idle powered-up or
+    powering-up nodes, then powered-down ones, within the limits.
+    """
+    powering = sum(1 for node in nodes.values()
+                   if node['state'].endswith('#'))
+    budget = min(max_nodes, max_powering - powering)
+    available = set(name for name, node in nodes.items()
+                    if node['state'] in ('idle', 'idle#'))
+    powered_down = set(name for name, node in nodes.items()
+                       if node['state'] == 'idle~')
+
+    selected = []
+    for job in jobs:
+        if budget <= 0:
+            break
+        job_partitions = job['partitions']
+        if partitions is not None:
+            job_partitions = job_partitions & partitions
+        free = sorted(
+            name for name in available
+            if _matches(nodes[name], job_partitions, job['features'])
+        )[:job['nodes']]
+        needed = job['nodes'] - len(free)
+        candidates = sorted(
+            name for name in powered_down
+            if _matches(nodes[name], job_partitions, job['features'])
+        )[:needed]
+        if len(candidates) < needed or needed > budget:
+            continue
+        available.difference_update(free)
+        powered_down.difference_update(candidates)
+        selected.extend(candidates)
+        budget -= needed
+        if candidates:
+            logger.info(f"selected {','.join(candidates)} for job "
+                        f"{job['id']}")
+    return selected
+
+
+def power_up(names):
+    """Ask slurmctld to resume nodes, as if jobs had been scheduled."""
+    nodeset = NodeSet.NodeSet.fromlist(names)
+    scontrol = metrics.run(
+        ['scontrol', 'update', f'nodename={nodeset}', 'state=power_up'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    if scontrol.returncode:
+        logger.error(f"Failed to power up {nodeset}: {scontrol.stdout}")
+
+
+def cycle(args):
+    """Sample the queue once and power up the nodes it needs."""
+    with tracing.span('cycle') as cycle_span:
+        jobs = get_pending_jobs()
+        names = []
+        if jobs:
+            partitions = (set(args.partitions.split(','))
+                          if args.partitions else None)
+            names = plan(jobs, get_nodes(), args.max_nodes,
+                         args.max_powering, partitions)
+        cycle_span.set('pending', len(jobs))
+        cycle_span.set('power_up', len(names))
+        if names and not args.dry_run:
+            logger.info(f"powering up {','.join(names)}")
+            power_up(names)
+    # A long-running process would otherwise only write metrics at exit
+    metrics.write()
+    return names
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Power up cloud nodes for pending jobs ahead of "
+                    "Slurm's own scheduling.")
+    parser.add_argument(
+        '--interval', type=int, default=DEFAULT_INTERVAL,
+        help=f"Seconds between queue samples (default: {DEFAULT_INTERVAL})")
+    parser.add_argument(
+        '--max-nodes', type=int, default=DEFAULT_MAX_NODES,
+        help="Most nodes to power up per sample "
+             f"(default: {DEFAULT_MAX_NODES})")
+    parser.add_argument(
+        '--max-powering', type=int, default=DEFAULT_MAX_POWERING,
+        help="Power up nothing while this many nodes are powering up "
+             f"(default: {DEFAULT_MAX_POWERING})")
+    parser.add_argument(
+        '--partitions', metavar='PARTITION,...',
+        help="Only power up nodes for these partitions (default: all)")
+    parser.add_argument(
+        '--once', action='store_true',
+        help="Sample the queue once and exit, e.g. from cron")
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="Log the nodes which would be powered up, but don't")
+    return parser.parse_args(argv)
+
+
+def main():
+    metrics.configure('preresume')
+    tracing.configure('preresume')
+    args = parse_args()
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                cycle(args)
+            except Exception:
+                if args.once:
+                    raise
+                logger.exception('Exception sampling the queue:')
+            if args.once:
+                break
+            time.sleep(max(0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        logger.exception('Exception in main:')
+        raise
@@ -12,15 +12,26 @@
  # License for the specific language governing permissions and limitations
  # under the License.
 
+import argparse
+import collections
+import concurrent.futures
+import json
 import logging.handlers
 import os
 import re
+import subprocess
 import sys
+import threading
+import time
 from pathlib import Path
 
 import openstack
 import yaml
 
+from slurm_openstack_tools import metrics
+from slurm_openstack_tools import throttle
+from slurm_openstack_tools import tracing
+
 # Configure logging to syslog
 logger = logging.getLogger("syslogger")
 logger.setLevel(logging.DEBUG)
@@ -31,22 +42,133 @@ logger.addHandler(handler)
 # Directory containing per-node configurations
 HOSTVARS_DIR = "/exports/cluster/hostvars"
 
+# Consolidated index of every node's instance_id/image_id, see build_index()
+HOSTVARS_INDEX = os.path.join(HOSTVARS_DIR, "hostvars-index.json")
+
+# Hostvars keys needed to decide between rebuild and reboot
+INDEX_KEYS = ("instance_id", "image_id")
+
+# Number of nodes processed concurrently by default
+DEFAULT_WORKERS = 16
+
+# Hostlists longer than this fetch all servers in one paginated listing
+# rather than one get_server call per node
+LIST_SERVERS_THRESHOLD = 8
+
+# Use libyaml's C loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Rolling mode defaults: nodes in flight per group per wave, seconds
+# between status polls and seconds to wait for a wave to become ACTIVE
+DEFAULT_MAX_PER_GROUP = 8
+DEFAULT_POLL_INTERVAL = 15
+DEFAULT_WAVE_TIMEOUT = 1800
+DEFAULT_MAX_FAILURES = 0
+
+# Seconds to let hypervisors download pre-cached images before rebuilding.
+# Nova does not report when caching has finished, so this is a fixed wait.
+DEFAULT_PRECACHE_WAIT = 300
+
+# Futures for image lookups keyed on image ID, shared by all workers
+_image_cache = {}
+_image_cache_lock = threading.Lock()
+
+
+def _hostvars_file(node):
+    if not re.match(r'^[A-Za-z0-9-]+$', node):
+        raise ValueError(f"Invalid node name: {node}. Node name must contain only alphanumeric characters.")
+    return Path(HOSTVARS_DIR) / node / "hostvars.yml"
+
+
+def _hostvars_stat(hostvars_file):
+    stat = hostvars_file.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
 
 def read_hostvars(node):
     """
     Read the hostvars.yml file for a specific node.
     """
-    if not re.match(r'^[A-Za-z0-9-]+$', node):
-        logger.error(f"Invalid node name: {node}. Node name must contain only alphanumeric characters.")
-        sys.exit(1)
-
-    hostvars_file = Path(HOSTVARS_DIR) / node / "hostvars.yml"
-    if not hostvars_file.exists():
+    hostvars_file = _hostvars_file(node)
+    try:
+        with open(hostvars_file, "r") as f:
+            return yaml.load(f, Loader=YAML_LOADER)
+    except FileNotFoundError:
         logger.warning(f"No hostvars.yml found for node: {node}")
         return None
 
-    with open(hostvars_file, "r") as f:
-        return yaml.safe_load(f)
+
+def get_hostvars(node, index=None):
+    """
+    Return a node's hostvars from the index, or from its hostvars.yml.
+
+    An index entry is only used while the node's hostvars.yml has the
+    mtime and size it was built from, which costs a stat() rather than
+    reading and parsing the file. A changed file is read instead, with a
+    warning if the stale entry had a different target image, and a node
+    whose file is gone is skipped as it would be without the index.
+    """
+    entry = index.get(node) if index else None
+    if entry is None:
+        return read_hostvars(node)
+    try:
+        if _hostvars_stat(_hostvars_file(node)) == entry.get("hostvars_stat"):
+            return entry
+    except FileNotFoundError:
+        logger.warning(f"No hostvars.yml found for node: {node}, ignoring its index entry")
+        return None
+    hostvars = read_hostvars(node)
+    if hostvars and hostvars.get("image_id") != entry.get("image_id"):
+        logger.warning(f"Hostvars index entry for node {node} is out of date: image "
+                       f"{entry.get('image_id')} is now {hostvars.get('image_id')}")
+    return hostvars
+
+
+def load_index(index_file=HOSTVARS_INDEX):
+    """
+    Read the consolidated hostvars index with a single file read.
+
+    Returns a dict mapping node names to their indexed hostvars.
+    """
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def _index_entry(node):
+    hostvars_file = _hostvars_file(node)
+    try:
+        # Taken first, so a file changed while it is read looks out of date
+        hostvars_stat = _hostvars_stat(hostvars_file)
+    except FileNotFoundError:
+        return None
+    hostvars = read_hostvars(node)
+    if not hostvars:
+        return None
+    entry = {k: hostvars.get(k) for k in INDEX_KEYS}
+    entry["hostvars_stat"] = hostvars_stat
+    return entry
+
+
+def build_index(index_file=HOSTVARS_INDEX, workers=DEFAULT_WORKERS):
+    """
+    Write the consolidated hostvars index for every node in HOSTVARS_DIR.
+
+    Each entry records the mtime and size of the hostvars.yml it came from,
+    see get_hostvars(). The index is written atomically so concurrent
+    readers never see a partial file. Returns the number of nodes indexed.
+    """
+    nodes = sorted(entry.name for entry in os.scandir(HOSTVARS_DIR)
+                   if entry.is_dir() and re.match(r'^[A-Za-z0-9-]+$', entry.name))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = pool.map(_index_entry, nodes)
+        index = {node: entry for node, entry in zip(nodes, entries) if entry}
+
+    tmp_file = f"{index_file}.tmp.{os.getpid()}"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, sort_keys=True)
+    os.replace(tmp_file, index_file)
+    logger.info(f"Wrote hostvars index for {len(index)} nodes to {index_file}")
+    return len(index)
 
 
 def find_server(conn, server_id):
@@ -54,7 +176,7 @@ def find_server(conn, server_id):
     Retrieve the server object using the server ID.
     """
     try:
-        server = conn.get_server(server_id)
+        server = throttle.call('get_server', conn.get_server, server_id)
         if not server:
             logger.error(f"Server with ID {server_id} not found.")
             return None
@@ -67,14 +189,56 @@ def find_server(conn, server_id):
         raise
 
 
-def process_node(conn, node):
+def list_servers(conn):
+    """
+    Fetch every server in the project with one paginated listing.
+
+    Returns a dict mapping server IDs to server objects.
+    """
+    servers = throttle.call(
+        'list_servers', lambda: list(conn.compute.servers(details=True)))
+    logger.debug(f"Listed {len(servers)} servers")
+    return {server.id: server for server in servers}
+
+
+def get_image(conn, image_id):
+    """
+    Retrieve an image, fetching each distinct image ID only once.
+    """
+    with _image_cache_lock:
+        future = _image_cache.get(image_id)
+        owner = future is None
+        if owner:
+            future = _image_cache[image_id] = concurrent.futures.Future()
+    if owner:
+        try:
+            future.set_result(throttle.call('get_image', conn.image.get_image, image_id))
+        except Exception as e:
+            future.set_exception(e)
+    return future.result()
+
+
+def get_current_image_id(server):
+    """
+    Return the ID of the image a server was built from, if known.
+    """
+    return server.image['id'] if 'image' in server and server.image else None
+
+
+def process_node(conn, node, index=None, servers=None, server_ids=None):
     """
     Process a single node by comparing its target and current images.
+
+    Hostvars are taken from the index if it has an up to date entry for the
+    node, and the server from the `servers` listing if it contains it.
+    If `server_ids` is given, the ID of a server rebuilt or rebooted is
+    stored in it under the node's name.
+    Returns the action taken: "rebuild", "reboot" or "skipped".
     """
-    hostvars = read_hostvars(node)
+    hostvars = get_hostvars(node, index)
     if not hostvars:
         logger.info(f"No hostvars defined for node {node}, skipping...")
-        return
+        return "skipped"
 
     server_id = hostvars.get("instance_id")
     target_image_id = hostvars.get("image_id")
@@ -85,74 +249,427 @@ def process_node(conn, node):
     if not target_image_id:
         raise ValueError(f"Node {node} does not have a target image defined. Exiting.")
 
-    # Fetch the server object once
-    server = find_server(conn, server_id)
+    # Fetch the server object once, unless it was already listed
+    server = servers.get(server_id) if servers else None
     if not server:
-        return
+        server = find_server(conn, server_id)
+    if not server:
+        return "skipped"
 
-    current_image_id = server.image['id'] if 'image' in server and server.image else None
+    current_image_id = get_current_image_id(server)
     if current_image_id != target_image_id:
         logger.info(f"Node {node} requires rebuild: current image {current_image_id}, target image {target_image_id}")
-        rebuild_node(conn, server, target_image_id)
+        if not rebuild_node(conn, server, target_image_id):
+            raise ValueError(f"Target image {target_image_id} for node {node} not found.")
+        action = "rebuild"
     else:
         logger.info(f"Node {node} is already using the target image, performing reboot...")
         reboot_node(conn, server)
+        action = "reboot"
+    if server_ids is not None:
+        server_ids[node] = server.id
+    return action
 
 
 def rebuild_node(conn, server, target_image_id):
     """
     Rebuild the node with the target image using the server object.
     """
-    image = conn.image.get_image(target_image_id)
+    image = get_image(conn, target_image_id)
     if not image:
         logger.error(f"Target image {target_image_id} not found in OpenStack")
         return False
 
-    conn.rebuild_server(server, image)
+    throttle.call('rebuild_server', conn.rebuild_server, server, image)
     logger.info(f"Rebuilding server {server.id} with image {target_image_id}.")
+    return True
 
 
 def reboot_node(conn, server, reboot_type="SOFT"):
     """
     Reboot the node using the server object (default: soft reboot).
     """
-    conn.compute.reboot_server(server, reboot_type=reboot_type)
+    throttle.call('reboot_server', conn.compute.reboot_server, server, reboot_type=reboot_type)
     logger.info(f"Rebooting server {server.id} with {reboot_type.lower()} reboot.")
 
 
-def main():
+def process_nodes(conn, hostlist, workers=DEFAULT_WORKERS, index=None, partitions=None,
+                  server_ids=None):
     """
-    Main function to process nodes from the Slurm-provided hostlist.
+    Process every node in the hostlist on a bounded thread pool.
+
+    partitions optionally maps nodes to their Slurm partitions, to label
+    the metrics recorded while processing them. server_ids is passed to
+    process_node().
+
+    Returns a dict mapping each node to its action, or to the exception
+    raised while processing it.
     """
-    if len(sys.argv) < 2:
-        logger.error("Usage: <script> <hostlist>")
-        sys.exit(1)
+    servers = None
+    if len(hostlist) > LIST_SERVERS_THRESHOLD:
+        try:
+            servers = list_servers(conn)
+        except Exception as e:
+            logger.warning(f"Failed to list servers, fetching them individually: {e}")
+
+    parent = tracing.current()
+
+    def work(node):
+        with metrics.partition(",".join((partitions or {}).get(node, []))), \
+                tracing.span("node", parent=parent, node=node):
+            return process_node(conn, node, index, servers, server_ids)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(work, node): node for node in hostlist}
+        for future in concurrent.futures.as_completed(futures):
+            node = futures[future]
+            try:
+                results[node] = future.result()
+            except Exception as e:
+                logger.error(f"Failed to process node {node}: {e}")
+                results[node] = e
+    return results
+
+
+def summarise(results):
+    """
+    Log a summary of the per-node results and return the number of failures.
+    """
+    counts = collections.Counter(
+        "failed" if isinstance(outcome, Exception) else outcome
+        for outcome in results.values())
+    logger.info("Processed {} nodes: {}".format(
+        len(results), ", ".join(f"{n} {action}" for action, n in sorted(counts.items()))))
+    failed = sorted(node for node, outcome in results.items() if isinstance(outcome, Exception))
+    if failed:
+        logger.error(f"{len(failed)} nodes failed to process: {','.join(failed)}")
+    return len(failed)
+
+
+def get_node_partitions(hostlist):
+    """
+    Return a dict mapping each node to the list of its Slurm partitions.
+    """
+    scontrol = metrics.run(
+        ["scontrol", "show", "node", ",".join(hostlist)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    partitions = {}
+    node = None
+    for line in scontrol.stdout.splitlines():
+        line = line.strip()
+        if line.startswith("NodeName"):  # NodeName=compute-0 Arch=x86_64
+            node = line.split()[0].split("=")[1]
+        if line.startswith("Partitions") and node:  # Partitions=compute,debug
+            partitions[node] = line.split("=", 1)[1].split(",")
+    return partitions
+
+
+def plan_waves(hostlist, groups, max_per_group):
+    """
+    Split the hostlist into waves with at most max_per_group nodes from
+    any one group in each wave.
+
+    groups maps nodes to the groups they belong to; a node in several
+    groups counts against all of them.
+    """
+    remaining = list(hostlist)
+    waves = []
+    while remaining:
+        in_wave = collections.Counter()
+        wave = []
+        deferred = []
+        for node in remaining:
+            node_groups = groups.get(node) or [None]
+            if all(in_wave[group] < max_per_group for group in node_groups):
+                wave.append(node)
+                in_wave.update(node_groups)
+            else:
+                deferred.append(node)
+        waves.append(wave)
+        remaining = deferred
+    return waves
+
+
+def wait_for_servers(conn, server_ids, timeout=DEFAULT_WAVE_TIMEOUT,
+                     poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Poll a single server listing until every server is ACTIVE again.
+
+    Nova sets the task state before a rebuild or reboot request returns, so
+    a server that is ACTIVE with no task state has finished. Returns a dict
+    mapping each server ID to "ACTIVE", "ERROR", "MISSING" or "TIMEOUT".
+    """
+    states = {}
+    pending = set(server_ids)
+    deadline = time.monotonic() + timeout
+    while pending:
+        servers = list_servers(conn)
+        for server_id in list(pending):
+            server = servers.get(server_id)
+            if server is None:
+                states[server_id] = "MISSING"
+            elif server.status == "ERROR":
+                states[server_id] = "ERROR"
+            elif server.status == "ACTIVE" and not server.task_state:
+                states[server_id] = "ACTIVE"
+            else:
+                continue
+            pending.discard(server_id)
+        if not pending:
+            break
+        if time.monotonic() >= deadline:
+            states.update((server_id, "TIMEOUT") for server_id in pending)
+            break
+        logger.debug(f"Waiting for {len(pending)} servers to become ACTIVE")
+        time.sleep(poll_interval)
+    return states
+
+
+def rolling_process_nodes(conn, hostlist, workers=DEFAULT_WORKERS, index=None,
+                          max_per_group=DEFAULT_MAX_PER_GROUP, group_by_partition=True,
+                          timeout=DEFAULT_WAVE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+                          max_failures=DEFAULT_MAX_FAILURES):
+    """
+    Process the hostlist in waves, waiting for each wave to become ACTIVE
+    before starting the next.
+
+    Once more than max_failures nodes have failed no further waves are
+    started, and their nodes are given the result "not attempted". Returns a
+    dict of per-node results like process_nodes().
+    """
+    partitions = get_node_partitions(hostlist)
+    groups = partitions if group_by_partition else {}
+    waves = plan_waves(hostlist, groups, max_per_group)
+    logger.info(f"Rolling over {len(hostlist)} nodes in {len(waves)} waves "
+                f"of at most {max_per_group} per {'partition' if group_by_partition else 'hostlist'}")
+
+    results = {}
+    started = time.monotonic()
+    for number, wave in enumerate(waves, 1):
+        with tracing.span("wave", number=number, nodes=len(wave)):
+            server_ids = {}
+            wave_results = process_nodes(conn, wave, workers=workers, index=index,
+                                         partitions=partitions, server_ids=server_ids)
+            # The servers process_node acted on, without reading hostvars again
+            in_flight = {server_id: node for node, server_id in server_ids.items()}
+            try:
+                with tracing.span("wait", servers=len(in_flight)):
+                    states = wait_for_servers(conn, in_flight, timeout=timeout, poll_interval=poll_interval)
+            except Exception as e:
+                logger.error(f"Failed to check servers in wave {number}: {e}")
+                states = {}
+                for server_id, node in in_flight.items():
+                    wave_results[node] = e
+        for server_id, state in states.items():
+            if state != "ACTIVE":
+                node = in_flight[server_id]
+                logger.error(f"Node {node} server {server_id} did not become ACTIVE: {state}")
+                wave_results[node] = RuntimeError(f"server {server_id} is {state}")
+        results.update(wave_results)
+
+        elapsed = time.monotonic() - started
+        eta = elapsed / number * (len(waves) - number)
+        failed = sum(isinstance(outcome, Exception) for outcome in results.values())
+        logger.info(f"Wave {number}/{len(waves)} complete: {len(results)}/{len(hostlist)} nodes done, "
+                    f"{failed} failed, elapsed {elapsed:.0f}s, ETA {eta:.0f}s")
+        if failed > max_failures and number < len(waves):
+            remaining = [node for later in waves[number:] for node in later]
+            logger.error(f"Stopping after wave {number}: {failed} nodes failed, more than "
+                         f"--max-failures {max_failures}; not attempted: {','.join(remaining)}")
+            results.update((node, "not attempted") for node in remaining)
+            break
+    return results
+
+
+def plan_precache(conn, hostlist, index=None):
+    """
+    Work out which hypervisors need which target images.
+
+    Returns a dict mapping image IDs to the set of hypervisor hostnames
+    running a server that will be rebuilt with that image.
+    """
+    servers = list_servers(conn)
+    hosts_by_image = collections.defaultdict(set)
+    for node in hostlist:
+        hostvars = get_hostvars(node, index)
+        if not hostvars:
+            continue
+        server = servers.get(hostvars.get("instance_id"))
+        target_image_id = hostvars.get("image_id")
+        if not server or not target_image_id:
+            continue
+        if get_current_image_id(server) == target_image_id:
+            continue
+        if not server.compute_host:
+            logger.warning(f"Hypervisor of node {node} is not visible, cannot pre-cache its image")
+            continue
+        hosts_by_image[target_image_id].add(server.compute_host)
+    return hosts_by_image
+
+
+def choose_aggregates(aggregates, hosts):
+    """
+    Greedily pick aggregates covering the given hypervisor hosts.
 
-    hostlist = sys.argv[1].split(",")
+    Returns the chosen aggregates and the set of hosts in no aggregate.
+    """
+    uncovered = set(hosts)
+    chosen = []
+    while uncovered:
+        best = max(aggregates, key=lambda agg: len(uncovered & set(agg.hosts or [])),
+                   default=None)
+        if best is None or not uncovered & set(best.hosts or []):
+            break
+        chosen.append(best)
+        uncovered -= set(best.hosts)
+    return chosen, uncovered
+
+
+def precache_images(conn, hostlist, index=None, wait=DEFAULT_PRECACHE_WAIT):
+    """
+    Ask Nova to pre-cache each target image on the aggregates hosting the
+    servers to be rebuilt with it, then wait for the downloads.
+
+    Returns the number of aggregates asked to pre-cache images.
+    """
+    hosts_by_image = plan_precache(conn, hostlist, index)
+    if not hosts_by_image:
+        logger.info("No images need pre-caching")
+        return 0
+
+    aggregates = throttle.call('list_aggregates', lambda: list(conn.compute.aggregates()))
+    images_by_aggregate = collections.defaultdict(set)
+    by_id = {}
+    for image_id, hosts in hosts_by_image.items():
+        chosen, uncovered = choose_aggregates(aggregates, hosts)
+        if uncovered:
+            logger.warning(f"Hypervisors {','.join(sorted(uncovered))} are in no aggregate, "
+                           f"cannot pre-cache image {image_id} on them")
+        for aggregate in chosen:
+            by_id[aggregate.id] = aggregate
+            images_by_aggregate[aggregate.id].add(image_id)
+
+    for aggregate_id, image_ids in images_by_aggregate.items():
+        aggregate = by_id[aggregate_id]
+        logger.info(f"Pre-caching images {','.join(sorted(image_ids))} on aggregate {aggregate.name}")
+        throttle.call('precache_images', conn.compute.aggregate_precache_images,
+                      aggregate, sorted(image_ids))
+
+    if images_by_aggregate and wait > 0:
+        logger.info(f"Waiting {wait}s for hypervisors to cache images")
+        time.sleep(wait)
+    return len(images_by_aggregate)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rebuild or reboot OpenStack nodes from a Slurm hostlist.")
+    parser.add_argument("hostlist", nargs="?", help="Comma-separated list of nodes")
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS,
+        help=f"Number of nodes to process concurrently (default: {DEFAULT_WORKERS})")
+    parser.add_argument(
+        "--index", metavar="PATH",
+        help=f"Read instance_id/image_id from a consolidated index, e.g. {HOSTVARS_INDEX}")
+    parser.add_argument(
+        "--build-index", action="store_true",
+        help="Write the consolidated index from all hostvars files, then exit")
+    parser.add_argument(
+        "--rolling", action="store_true",
+        help="Process nodes in waves, waiting for each wave to become ACTIVE")
+    parser.add_argument(
+        "--max-per-group", type=int, default=DEFAULT_MAX_PER_GROUP,
+        help=f"Rolling mode: nodes per partition in each wave (default: {DEFAULT_MAX_PER_GROUP})")
+    parser.add_argument(
+        "--no-group-by-partition", dest="group_by_partition", action="store_false",
+        help="Rolling mode: apply --max-per-group to the whole hostlist")
+    parser.add_argument(
+        "--wave-timeout", type=int, default=DEFAULT_WAVE_TIMEOUT,
+        help=f"Rolling mode: seconds to wait for a wave (default: {DEFAULT_WAVE_TIMEOUT})")
+    parser.add_argument(
+        "--poll-interval", type=int, default=DEFAULT_POLL_INTERVAL,
+        help=f"Rolling mode: seconds between status polls (default: {DEFAULT_POLL_INTERVAL})")
+    parser.add_argument(
+        "--max-failures", type=int, default=DEFAULT_MAX_FAILURES,
+        help=f"Rolling mode: start no more waves once more than this many nodes "
+             f"have failed (default: {DEFAULT_MAX_FAILURES})")
+    parser.add_argument(
+        "--precache", action="store_true",
+        help="Pre-cache target images on the hypervisors' aggregates before rebuilding")
+    parser.add_argument(
+        "--precache-wait", type=int, default=DEFAULT_PRECACHE_WAIT,
+        help=f"Seconds to wait after requesting pre-caching (default: {DEFAULT_PRECACHE_WAIT})")
+    args = parser.parse_args(argv)
+    if not args.hostlist and not args.build_index:
+        parser.error("a hostlist is required unless --build-index is given")
+    return args
+
+
+def rebuild(args):
+    """
+    Rebuild or reboot the nodes in the hostlist, returning the exit status.
+    """
+    hostlist = args.hostlist.split(",")
+
+    index = None
+    if args.index:
+        try:
+            index = load_index(args.index)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read hostvars index {args.index}, using hostvars files: {e}")
 
     try:
-        conn = openstack.connection.from_config()
+        with tracing.span("auth"):
+            conn = openstack.connection.from_config()
         logger.debug("OpenStack connection established")
     except Exception as e:
         logger.error(f"Failed to establish OpenStack connection: {e}")
-        sys.exit(1)
+        return 1
 
-    failed_nodes = 0
-
-    for node in hostlist:
-        logger.debug(f"Processing node: {node}")
+    if args.precache:
         try:
-            process_node(conn, node)
+            with tracing.span("precache"):
+                precache_images(conn, hostlist, index=index, wait=args.precache_wait)
         except Exception as e:
-            logger.error(f"Failed to process node {node}: {e}")
-            failed_nodes += 1
+            logger.warning(f"Image pre-caching failed, rebuilding without it: {e}")
+
+    if args.rolling:
+        results = rolling_process_nodes(
+            conn, hostlist, workers=args.workers, index=index,
+            max_per_group=args.max_per_group, group_by_partition=args.group_by_partition,
+            timeout=args.wave_timeout, poll_interval=args.poll_interval,
+            max_failures=args.max_failures)
+    else:
+        results = process_nodes(conn, hostlist, workers=args.workers, index=index,
+                                partitions=get_node_partitions(hostlist))
 
-        if failed_nodes > 0:
-            logger.error(f"{failed_nodes} nodes failed to process. Exiting with error.")
-            sys.exit(1)
+    if summarise(results) > 0:
+        logger.error("Some nodes failed to process. Exiting with error.")
+        return 1
 
     logger.info("All nodes processed successfully.")
-    sys.exit(0)
+    return 0
+
+
+def main():
+    """
+    Main function to process nodes from the Slurm-provided hostlist.
+    """
+    metrics.configure("rebuild")
+    tracing.configure("rebuild")
+    if len(sys.argv) < 2:
+        logger.error("Usage: <script> <hostlist>")
+        sys.exit(1)
+
+    args = parse_args()
+    if args.build_index:
+        build_index(args.index or HOSTVARS_INDEX, workers=args.workers)
+        sys.exit(0)
+
+    with tracing.span("rebuild", hostlist=args.hostlist):
+        status = rebuild(args)
+    sys.exit(status)
 
 
 if __name__ == "__main__":
@@ -34,6 +34,20 @@ application credential in /etc/openstack/clouds.yaml readable by the slurm
 user). DNS must be available and `SlurmctldParameters=cloud_dns` set in the
 slurm.conf [4].
 
+Set SLURM_OPENSTACK_PORTS=bulk to create the Neutron ports for all the nodes
+up front, in one bulk request per network, and boot the servers on them.
+The port ID is recorded on the second line of the node's file, and ports are
+deleted again if their server could not be created. With
+SLURM_OPENSTACK_PORTS=reuse the suspend program keeps the ports, and the
+next resume of the node boots it on the same port.
+
+Set SLURM_OPENSTACK_NODEADDR=1 to tell Slurm the new servers' fixed IPs
+directly, rather than waiting for DNS. Once all the servers have been
+requested (or one has failed), a single server listing is polled until each
+server created has an address or is in ERROR, and the addresses are set with
+as few `scontrol update nodename=<hostlist> nodeaddr=<addresses>` commands as
+possible.
+
 [1]: https://slurm.schedmd.com/slurm.conf.html#OPT_ResumeProgram [2]:
 https://slurm.schedmd.com/slurm.conf.html#OPT_SlurmdSpoolDir [3]:
 https://slurm.schedmd.com/slurm.conf.html#OPT_Features [4]:
@@ -41,15 +55,33 @@ https://slurm.schedmd.com/slurm.conf.html#OPT_cloud_dns
 
 """
 
+import collections
+import ipaddress
 import logging.handlers
 import os
+import re
 import subprocess
 import sys
+import time
 
+from ClusterShell import NodeSet
 import openstack
 
+from slurm_openstack_tools import metrics
+from slurm_openstack_tools import throttle
+from slurm_openstack_tools import tracing
+
 REQUIRED_PARAMS = ('image', 'flavor', 'keypair', 'network')
 
+PORTS_ENV = 'SLURM_OPENSTACK_PORTS'
+NODEADDR_ENV = 'SLURM_OPENSTACK_NODEADDR'
+
+# Seconds to wait for new servers' fixed IPs, and between polls for them
+ADDRESS_TIMEOUT = 300
+ADDRESS_POLL_INTERVAL = 2
+# Most nodes set by one scontrol update, to bound its command line
+NODEADDR_BATCH = 1000
+
 # configure logging to syslog - by default only "info" and above
 # categories appear
 logger = logging.getLogger("syslogger")
@@ -61,7 +93,7 @@ logger.addHandler(handler)
 
 def get_statesavelocation():
     """Return the path for Slurm's StateSaveLocation """
-    scontrol = subprocess.run(
+    scontrol = metrics.run(
         ['scontrol', 'show', 'config'],
         stdout=subprocess.PIPE, universal_newlines=True)
     for line in scontrol.stdout.splitlines():
@@ -71,46 +103,344 @@ def get_statesavelocation():
 
 
 def expand_nodes(hostlist_expr):
-    scontrol = subprocess.run(
+    scontrol = metrics.run(
         ['scontrol', 'show', 'hostnames', hostlist_expr],
         stdout=subprocess.PIPE, universal_newlines=True)
     return scontrol.stdout.strip().split('\n')
 
 
-def get_features(nodenames):
-    """Retrieve the features specified for given node(s).
+def get_node_fields(nodenames, fields):
+    """Retrieve comma-separated fields of given node(s) from scontrol.
 
-    Returns a dict with a key/value pair for each node. Keys are node names,
-    values are lists of strings, one string per feature.
+    Returns a dict with a key for each field. Values are dicts with a
+    key/value pair for each node; keys are node names, values are lists of
+    strings, one string per item in the field.
     """
 
-    scontrol = subprocess.run(
+    scontrol = metrics.run(
         ['scontrol', 'show', 'node', nodenames],
         stdout=subprocess.PIPE, universal_newlines=True)
-    features = {}
+    values = dict((field, {}) for field in fields)
     for line in scontrol.stdout.splitlines():
         line = line.strip()
         if line.startswith(
             'NodeName'):  # NodeName=dev-small-cloud-1 CoresPerSocket=1
             node = line.split()[0].split('=')[1]
-        if line.startswith('AvailableFeatures'):
-            feature_args = line.split('=', 1)[1]
-            features[node] = feature_args.split(',')
+        field = line.split('=', 1)[0]
+        if field in values:
+            values[field][node] = line.split('=', 1)[1].split(',')
+
+    return values
+
+
+def get_features(nodenames):
+    """Retrieve the features specified for given node(s).
+
+    Returns a dict with a key/value pair for each node. Keys are node names,
+    values are lists of strings, one string per feature.
+    """
+    return get_node_fields(nodenames, ['AvailableFeatures'])[
+        'AvailableFeatures']
+
+
+def read_state(statedir, node):
+    """Return the (server ID, port ID) recorded for a node, or Nones."""
+    try:
+        with open(os.path.join(statedir, node)) as f:
+            lines = f.read().split()
+    except FileNotFoundError:
+        return None, None
+    return (lines[0] if lines else None), (
+        lines[1] if len(lines) > 1 else None)
+
+
+def create_ports(conn, network, names):
+    """Create a port on network for each name in one bulk request."""
+    return list(conn.network.create_ports(
+        [{'network_id': network.id, 'name': name} for name in names]))
+
 
-    return features
+def list_ports(conn, network):
+    return list(conn.network.ports(network_id=network.id))
 
 
-def create_server(conn, name, image, flavor, network, keypair):
+def find_new_ports(conn, network, names):
+    """Return the unbound ports a failed bulk create may have made.
 
-    server = conn.compute.create_server(
+    Returns a list of ports in the order of names, or None unless every
+    name has one.
+    """
+    ports = dict(
+        (port.name, port) for port in list_ports(conn, network)
+        if port.name in names and not (port.device_owner or port.device_id))
+    if all(name in ports for name in names):
+        return [ports[name] for name in names]
+    return None
+
+
+def delete_ports(conn, ports):
+    for port in ports:
+        logger.info(f"deleting port {port.id}")
+        throttle.call('delete_port', conn.network.delete_port, port)
+
+
+def prepare_ports(conn, nodes, features, statedir):
+    """Get a Neutron port for each node to boot on.
+
+    Unbound ports recorded for nodes by an earlier resume are reused; ports
+    for the rest are created with one bulk request per network. If any
+    request fails, the ports created so far are deleted. Returns
+    (ports, created): a dict of node names to ports, and the set of IDs of
+    ports created here.
+    """
+    by_network = collections.defaultdict(list)
+    for node in nodes:
+        os_parameters = dict(
+            feature.split('=') for feature in features.get(node, []))
+        if 'network' in os_parameters:
+            by_network[os_parameters['network']].append(node)
+
+    ports = {}
+    created = set()
+    try:
+        for network_name, network_nodes in by_network.items():
+            network = throttle.call(
+                'find_network', conn.network.find_network, network_name)
+            if network is None:
+                # resume_node reports this for each node
+                continue
+            recorded = dict(
+                (node, read_state(statedir, node)) for node in network_nodes)
+            existing = {}
+            if any(port_id for _, port_id in recorded.values()):
+                existing = dict(
+                    (port.id, port) for port in
+                    throttle.call('list_ports', list_ports, conn, network))
+
+            stale = []
+            missing = []
+            for node in network_nodes:
+                server_id, port_id = recorded[node]
+                port = existing.get(port_id)
+                if port is not None and not port.device_id:
+                    ports[node] = port
+                    continue
+                if port is not None and port.device_id == server_id:
+                    # Still bound to the server suspend deleted
+                    stale.append(port)
+                missing.append(node)
+            delete_ports(conn, stale)
+
+            if missing:
+                logger.info(
+                    f"creating {len(missing)} ports on network {network_name}")
+                new_ports = dict(
+                    (port.name, port) for port in throttle.call(
+                        'create_ports', create_ports, conn, network, missing,
+                        lookup=lambda: throttle.call(
+                            'list_ports', find_new_ports, conn, network,
+                            missing)))
+                for node in missing:
+                    ports[node] = new_ports[node]
+                    created.add(new_ports[node].id)
+    except BaseException:
+        # Don't leak the ports already created for other networks
+        delete_ports(
+            conn, [port for port in ports.values() if port.id in created])
+        raise
+    return ports, created
+
+
+def get_fixed_ip(addresses):
+    """Return the first fixed IPv4 address in a server's addresses."""
+    for network_addresses in (addresses or {}).values():
+        for address in network_addresses:
+            if address.get('OS-EXT-IPS:type', 'fixed') != 'fixed':
+                continue
+            if address.get('version') == 4:
+                return address['addr']
+    return None
+
+
+def get_port_ip(port):
+    """Return the first fixed IPv4 address of a port, like get_fixed_ip."""
+    for fixed_ip in port.fixed_ips or []:
+        address = fixed_ip.get('ip_address')
+        if address and ipaddress.ip_address(address).version == 4:
+            return address
+    return None
+
+
+def list_servers(conn):
+    return list(conn.compute.servers(details=True))
+
+
+def find_new_server(conn, name):
+    """Return the newest server called name, or None."""
+    servers = [
+        server for server in
+        conn.compute.servers(details=True, name=f'^{re.escape(name)}$')
+        if server.name == name]
+    return max(servers, key=lambda server: server.created_at or '',
+               default=None)
+
+
+def wait_for_addresses(conn, server_ids, timeout=ADDRESS_TIMEOUT,
+                       poll_interval=ADDRESS_POLL_INTERVAL):
+    """Poll a single server listing until every server has a fixed IP.
+
+    server_ids maps node names to server IDs. Returns a dict mapping node
+    names to addresses, without the nodes that had none by the timeout or
+    whose server went into ERROR first.
+    """
+    addresses = {}
+    pending = dict(server_ids)
+    deadline = time.monotonic() + timeout
+    while pending:
+        servers = dict(
+            (server.id, server) for server in
+            throttle.call('list_servers', list_servers, conn))
+        for node, server_id in list(pending.items()):
+            server = servers.get(server_id)
+            address = get_fixed_ip(server.addresses if server else None)
+            if address:
+                addresses[node] = address
+                del pending[node]
+            elif server is not None and server.status == 'ERROR':
+                logger.error(
+                    f"server {server_id} for {node} is in ERROR, "
+                    "not setting its nodeaddr")
+                del pending[node]
+        if not pending:
+            break
+        if time.monotonic() >= deadline:
+            logger.warning(
+                f"No address after {timeout}s for {','.join(pending)}")
+            break
+        time.sleep(poll_interval)
+    return addresses
+
+
+def update_nodeaddrs(addresses, batch_size=NODEADDR_BATCH):
+    """Set NodeAddr for many nodes with few scontrol commands.
+
+    Each command names its nodes as a folded hostlist, with the addresses
+    in the order Slurm expands it.
+    """
+    nodes = list(NodeSet.NodeSet.fromlist(addresses))
+    for i in range(0, len(nodes), batch_size):
+        nodeset = NodeSet.NodeSet.fromlist(nodes[i:i + batch_size])
+        nodeaddrs = ','.join(addresses[node] for node in nodeset)
+        logger.info(f"setting nodeaddr={nodeaddrs} for {nodeset}")
+        scontrol = metrics.run(
+            ['scontrol', 'update', f'nodename={nodeset}',
+             f'nodeaddr={nodeaddrs}'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        if scontrol.returncode:
+            logger.error(
+                f"Failed to set nodeaddr for {nodeset}: {scontrol.stdout}")
+
+
+def set_nodeaddrs(conn, servers, ports):
+    """Tell Slurm the fixed IPs of new servers, polling for any unknown.
+
+    servers maps node names to new servers. Nodes booted on pre-created
+    ports already know their address.
+    """
+    addresses = {}
+    for node in servers:
+        port = ports.get(node)
+        address = get_port_ip(port) if port is not None else None
+        if address:
+            addresses[node] = address
+    pending = dict(
+        (node, server.id) for node, server in servers.items()
+        if node not in addresses)
+    if pending:
+        addresses.update(wait_for_addresses(conn, pending))
+    if addresses:
+        update_nodeaddrs(addresses)
+
+
+def create_server(conn, name, image, flavor, network, keypair, port=None):
+
+    if port is not None:
+        networks = [{"port": port.id}]
+    else:
+        networks = [{"uuid": network.id}]
+    server = throttle.call(
+        'create_server', conn.compute.create_server,
         name=name, image_id=image.id, flavor_id=flavor.id,
-        networks=[{"uuid": network.id}], key_name=keypair.name,
+        networks=networks, key_name=keypair.name,
+        lookup=lambda: throttle.call(
+            'list_servers', find_new_server, conn, name),
     )
     # server = conn.compute.wait_for_server(...)
 
     return server
 
 
+def resume_node(conn, node, features, statedir, debug=False, port=None):
+    """Create the OpenStack instance for a single node.
+
+    If port is given the server is booted on that Neutron port rather than
+    having one created by Nova. Returns the new server, or None in debug
+    mode.
+    """
+    # extract the openstack parameters from node features:
+    if node not in features:
+        logger.error(
+            f"No Feature definitions found for node {node}: {features}")
+    os_parameters = dict(feature.split('=') for feature in features[node])
+    if debug:
+        logger.info(f"os_parameters for {node}: {os_parameters}")
+    missing = set(REQUIRED_PARAMS).difference(os_parameters.keys())
+    if missing:
+        logger.error(
+            f"Missing {','.join(missing)} from feature definition for "
+            f"node {node}: {os_parameters}"
+        )
+
+    # get openstack objects:
+    os_objects = {
+        'image': throttle.call(
+            'find_image', conn.compute.find_image,
+            os_parameters['image']),
+        'flavor': throttle.call(
+            'find_flavor', conn.compute.find_flavor,
+            os_parameters['flavor']),
+        'network': throttle.call(
+            'find_network', conn.network.find_network,
+            os_parameters['network']),
+        'keypair': throttle.call(
+            'find_keypair', conn.compute.find_keypair,
+            os_parameters['keypair']),
+    }
+    not_found = dict((k, v) for (k, v) in os_objects.items() if v is None)
+    if not_found:
+        raise ValueError(
+            'Could not find openstack objects for: %s' %
+            ', '.join(not_found))
+    if debug:
+        logger.info(f"os_objects for {node} : {os_objects}")
+    if not debug:
+        logger.info(f"creating node {node}")
+        # TODO(stevebrasier): save id to disk so can use it instead of name
+        # on deletion (to cope with multiple instances with same name)
+        server = create_server(conn, node, port=port, **os_objects)
+        logger.info(f"server: {server}")
+        with tracing.span('write_state', node=node), \
+                open(os.path.join(statedir, node), 'w') as f:
+            f.write(server.id)
+            if port is not None:
+                f.write('\n' + port.id)
+        # Unless NODEADDR_ENV is set, don't need scontrol update
+        # nodename={node} nodeaddr={server_ip} as using
+        # SlurmctldParameters=cloud_dns
+        return server
+
+
 def resume():
     debug = False
     if len(sys.argv) > 2:
@@ -120,58 +450,49 @@ def resume():
     logger.info(f"Slurmctld invoked resume {hostlist_expr}")
     new_nodes = expand_nodes(hostlist_expr)
 
-    conn = openstack.connection.from_config()
+    with tracing.span('auth'):
+        conn = openstack.connection.from_config()
     logger.info(f"Got openstack connection {conn}")
 
-    features = get_features(hostlist_expr)
+    node_fields = get_node_fields(
+        hostlist_expr, ['AvailableFeatures', 'Partitions'])
+    features = node_fields['AvailableFeatures']
+    partitions = node_fields['Partitions']
     logger.info(f"Read feature information from slurm")
 
     statedir = get_statesavelocation()
 
-    for node in new_nodes:
-        # extract the openstack parameters from node features:
-        if node not in features:
-            logger.error(
-                f"No Feature definitions found for node {node}: {features}")
-        os_parameters = dict(feature.split('=') for feature in features[node])
-        if debug:
-            logger.info(f"os_parameters for {node}: {os_parameters}")
-        missing = set(REQUIRED_PARAMS).difference(os_parameters.keys())
-        if missing:
-            logger.error(
-                f"Missing {','.join(missing)} from feature definition for "
-                f"node {node}: {os_parameters}"
-            )
-
-        # get openstack objects:
-        os_objects = {
-            'image': conn.compute.find_image(os_parameters['image']),
-            'flavor': conn.compute.find_flavor(os_parameters['flavor']),
-            'network': conn.network.find_network(os_parameters['network']),
-            'keypair': conn.compute.find_keypair(os_parameters['keypair']),
-        }
-        not_found = dict((k, v) for (k, v) in os_objects.items() if v is None)
-        if not_found:
-            raise ValueError(
-                'Could not find openstack objects for: %s' %
-                ', '.join(not_found))
-        if debug:
-            logger.info(f"os_objects for {node} : {os_objects}")
-        if not debug:
-            logger.info(f"creating node {node}")
-            # TODO(stevebrasier): save id to disk so can use it instead of name
-            # on deletion (to cope with multiple instances with same name)
-            server = create_server(conn, node, **os_objects)
-            logger.info(f"server: {server}")
-            with open(os.path.join(statedir, node), 'w') as f:
-                f.write(server.id)
-            # Don't need scontrol update nodename={node} nodeaddr={server_ip}
-            # as using SlurmctldParameters=cloud_dns
+    ports, created = {}, set()
+    if os.environ.get(PORTS_ENV) in ('bulk', 'reuse') and not debug:
+        with tracing.span('ports'):
+            ports, created = prepare_ports(
+                conn, new_nodes, features, statedir)
+
+    resumed = {}
+    try:
+        for node in new_nodes:
+            with metrics.partition(','.join(partitions.get(node, []))), \
+                    tracing.span('node', node=node):
+                resumed[node] = resume_node(
+                    conn, node, features, statedir, debug,
+                    port=ports.get(node))
+    finally:
+        # Don't leak the ports created for nodes that never got a server
+        delete_ports(conn, [
+            port for node, port in ports.items()
+            if node not in resumed and port.id in created])
+        # Servers created before any failure still need to be reachable
+        if os.environ.get(NODEADDR_ENV) and resumed and not debug:
+            with tracing.span('nodeaddr'):
+                set_nodeaddrs(conn, resumed, ports)
 
 
 def main():
+    metrics.configure('resume')
+    tracing.configure('resume')
     try:
-        resume()
+        with tracing.span('resume', hostlist=' '.join(sys.argv[1:])):
+            resume()
     except BaseException:
         logger.exception('Exception in main:')
         raise
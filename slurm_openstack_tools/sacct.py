@@ -1,53 +1,149 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import concurrent.futures
 import datetime
 import json
+import os
 import re
 import subprocess
+import sys
+import time
 
 from ClusterShell import NodeSet
 
+from slurm_openstack_tools import jsonlines
+from slurm_openstack_tools import metrics
+from slurm_openstack_tools import occupancy
+
 SLURM_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 TIMESTAMP_FILE = "lasttimestamp"
+# Per-cluster checkpoints for --clusters, as {cluster: timestamp} JSON
+CLUSTERS_STATE_FILE = "lasttimestamps.json"
 
+SACCT_ARGS = [
+    "sacct", "-X", "--allusers", "--parsable2", "--format",
+    "jobid,jobidraw,cluster,partition,account,group,gid,"
+    "user,uid,submit,eligible,start,end,elapsed,elapsedraw,exitcode,state,"
+    "nnodes,ncpus,reqcpus,reqmem,reqtres,timelimit,nodelist,jobname",
+    "--state",
+    "CANCELLED,COMPLETED,FAILED,NODE_FAIL,PREEMPTED,TIMEOUT"]
 
-def main():
-    args = [
-        "sacct", "-X", "--allusers", "--parsable2", "--format",
-        "jobid,jobidraw,cluster,partition,account,group,gid,"
-        "user,uid,submit,eligible,start,end,elapsed,elapsedraw,exitcode,state,"
-        "nnodes,ncpus,reqcpus,reqmem,reqtres,timelimit,nodelist,jobname",
-        "--state",
-        "CANCELLED,COMPLETED,FAILED,NODE_FAIL,PREEMPTED,TIMEOUT"]
-    # Work out starttime and endtime
-    now = datetime.datetime.utcnow()
-    end_str = now.strftime(SLURM_DATE_FORMAT)
+# Follow mode defaults: seconds between polls, and how far each window
+# reaches back before the previous one to catch records slurmdbd was late
+# to store
+DEFAULT_INTERVAL = 10
+DEFAULT_OVERLAP = 300
 
+
+def read_start():
+    """Return the start of the next window, as a Slurm date string."""
     try:
         with open(TIMESTAMP_FILE) as f:
-            start_str = f.read()
+            return f.read()
     except FileNotFoundError:
-        # Default to last year. It seems that if you specify a time in the
-        # distance past then you get no results back.
-        last_year = now - datetime.timedelta(days=365)
-        start_str = last_year.strftime(SLURM_DATE_FORMAT)
+        return default_start()
 
-    args += ["--starttime", start_str]
-    args += ["--endtime", end_str]
 
-    # print(" ".join(args))
-    process = subprocess.run(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT, encoding="UTF-8")
+def write_start(next_time):
+    """Write out timestamp, so we know where to start next time."""
+    with open(TIMESTAMP_FILE, 'w') as f:
+        f.write(next_time.strftime(SLURM_DATE_FORMAT))
+
+
+def default_start():
+    # Default to last year. It seems that if you specify a time in the
+    # distance past then you get no results back.
+    last_year = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    return last_year.strftime(SLURM_DATE_FORMAT)
+
+
+def read_cluster_starts():
+    """Return the saved start of the next window for each cluster."""
+    try:
+        with open(CLUSTERS_STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_cluster_starts(starts):
+    """Write out all per-cluster timestamps atomically."""
+    tmp_path = "%s.tmp.%d" % (CLUSTERS_STATE_FILE, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(starts, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, CLUSTERS_STATE_FILE)
+
+
+def run_sacct(start_str, end_str, cluster=None):
+    """Run sacct over a window, returning its output lines."""
+    args = SACCT_ARGS + ["--starttime", start_str, "--endtime", end_str]
+    if cluster:
+        args += ["-M", cluster]
+    process = metrics.run(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, encoding="UTF-8")
+    return process.stdout.split("\n")
 
+
+def expand_nodelist(nodelist, cache=None):
+    """Expand a NodeList into node names, memoised in cache if given."""
+    if cache is not None and nodelist in cache:
+        return cache[nodelist]
+    nodeset = NodeSet.NodeSet(nodelist)
+    nodes = list([x for x in nodeset])
+    if cache is not None:
+        cache[nodelist] = nodes
+    return nodes
+
+
+def parse_item(attributes, components, nodelist_cache=None):
+    """Convert one line of sacct output into a dict."""
+    item = {}
+    for i in range(len(attributes)):
+        key = attributes[i]
+        value = components[i]
+
+        # Try to convert to int
+        if "JobID" not in key:
+            try:
+                value = int(value)
+            except BaseException:
+                pass
+        item[key] = value
+
+    # Unpack NodeList format, so its easier to search for hostnames
+    nodelist = item.get("NodeList")
+    if nodelist:
+        nodes = expand_nodelist(nodelist, nodelist_cache)
+        item["AllNodes"] = nodes
+        # Produce a prometheus style regex
+        nodes_regex = "|".join([re.escape(x) for x in nodes])
+        item["AllNodesRegex"] = nodes_regex
+
+    start = item.get("Start")
+    if start and start != 'None':  # latter is job cancelled before starting
+        item["StartEpoch"] = int(datetime.datetime.strptime(
+            start, SLURM_DATE_FORMAT).timestamp() * 1000)
+
+    end = item.get("End")
+    if end:
+        item["EndEpoch"] = int(datetime.datetime.strptime(
+            end, SLURM_DATE_FORMAT).timestamp() * 1000)
+
+    return item
+
+
+def parse_lines(lines, nodelist_cache=None):
+    """Parse sacct output into job dicts, excluding job steps.
+
+    Returns None if the output has no usable title line.
+    """
     # Use the title line to work out the attribute order
-    lines = process.stdout.split("\n")
     titles_line = lines[0]
     attributes = titles_line.split("|")
-
-    # Try to output any errors we might have hit
     if len(attributes) < 3:
-        print(lines)
-        exit(-1)
+        return None
 
     # Parse each line of sacct output into a dict
     items = []
@@ -56,56 +152,228 @@ def main():
         if len(components) != len(attributes):
             continue
 
-        item = {}
-        for i in range(len(attributes)):
-            key = attributes[i]
-            value = components[i]
-
-            # Try to convert to int
-            if "JobID" not in key:
-                try:
-                    value = int(value)
-                except BaseException:
-                    pass
-            item[key] = value
-
-        # Unpack NodeList format, so its easier to search for hostnames
-        nodelist = item.get("NodeList")
-        if nodelist:
-            nodeset = NodeSet.NodeSet(nodelist)
-            nodes = list([x for x in nodeset])
-            item["AllNodes"] = nodes
-            # Produce a prometheus style regex
-            nodes_regex = "|".join([re.escape(x) for x in nodes])
-            item["AllNodesRegex"] = nodes_regex
-
-        start = item.get("Start")
-        if start and start != 'None': # latter is job cancelled before starting
-            item["StartEpoch"] = int(datetime.datetime.strptime(
-                start, SLURM_DATE_FORMAT).timestamp() * 1000)
-
-        end = item.get("End")
-        if end:
-            item["EndEpoch"] = int(datetime.datetime.strptime(
-                end, SLURM_DATE_FORMAT).timestamp() * 1000)
+        item = parse_item(attributes, components, nodelist_cache)
 
         # Exclude job steps
         jobid = item.get("JobID")
         if jobid and "." not in jobid:
             items.append(item)
-            print(json.dumps(item))
+    return items
+
+
+def follow(interval=DEFAULT_INTERVAL, overlap=DEFAULT_OVERLAP, writer=None):
+    """Poll short overlapping windows forever, printing each job once.
+
+    Jobs already printed are remembered until they end before the start of
+    the current window. The checkpoint in TIMESTAMP_FILE trails the newest
+    window by the overlap, so a restart repeats at most that much.
+    """
+    writer = writer or jsonlines.Writer(sys.stdout)
+    nodelist_cache = {}
+    seen = {}
+    start = datetime.datetime.strptime(read_start(), SLURM_DATE_FORMAT)
+    while True:
+        polled = time.monotonic()
+        now = datetime.datetime.utcnow()
+        lines = run_sacct(start.strftime(SLURM_DATE_FORMAT),
+                          now.strftime(SLURM_DATE_FORMAT))
+        items = parse_lines(lines, nodelist_cache)
+        if items is None:
+            print(lines, file=sys.stderr)
+        else:
+            for item in items:
+                key = (item.get("Cluster"), item["JobIDRaw"])
+                if key in seen:
+                    continue
+                seen[key] = item.get("EndEpoch", time.time() * 1000)
+                writer.write(item)
+            writer.flush()
+
+            start = max(start, now - datetime.timedelta(seconds=overlap))
+            write_start(start)
+            # Interpreted like EndEpoch, so both agree when TZ=UTC
+            horizon = start.timestamp() * 1000
+            for key in [k for k, end in seen.items() if end < horizon]:
+                del seen[key]
+            if len(nodelist_cache) > 100000:
+                nodelist_cache.clear()
+
+        # atexit handlers don't run when the service is stopped with SIGTERM
+        metrics.write()
+        time.sleep(max(0, interval - (time.monotonic() - polled)))
+
+
+def fetch_cluster(cluster, start_str, end_str, nodelist_cache):
+    """Return the jobs sacct reports for one cluster, or None on error."""
+    lines = run_sacct(start_str, end_str, cluster)
+    items = parse_lines(lines, nodelist_cache)
+    if items is None:
+        print("%s: %s" % (cluster, "\n".join(lines)), file=sys.stderr)
+        return None
+    for item in items:
+        item["Cluster"] = item.get("Cluster") or cluster
+    return items
+
+
+def fetch_clusters(clusters, writer=None):
+    """Print new jobs from several clusters, querying them concurrently.
+
+    Each cluster has its own checkpoint in CLUSTERS_STATE_FILE, advanced
+    only if its query succeeded. Jobs are printed one cluster after another,
+    each tagged with its Cluster. Returns the number of failed clusters.
+    """
+    writer = writer or jsonlines.Writer(sys.stdout)
+    now = datetime.datetime.utcnow()
+    end_str = now.strftime(SLURM_DATE_FORMAT)
+    starts = read_cluster_starts()
+    nodelist_cache = {}
+    with concurrent.futures.ThreadPoolExecutor(len(clusters)) as executor:
+        futures = [
+            executor.submit(fetch_cluster, cluster,
+                            starts.get(cluster) or default_start(), end_str,
+                            nodelist_cache)
+            for cluster in clusters]
+
+    failed = 0
+    next_str = (now + datetime.timedelta(seconds=1)).strftime(
+        SLURM_DATE_FORMAT)
+    for cluster, future in zip(clusters, futures):
+        items = future.result()
+        if items is None:
+            failed += 1
+            continue
+        for item in items:
+            writer.write(item)
+        starts[cluster] = next_str
+    writer.flush()
+    write_cluster_starts(starts)
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Print finished Slurm jobs as JSON lines.")
+    parser.add_argument(
+        "--clusters", metavar="CLUSTER,...",
+        help="Query these clusters concurrently (sacct -M), keeping a "
+             f"checkpoint for each in {CLUSTERS_STATE_FILE}")
+    parser.add_argument(
+        "--follow", action="store_true",
+        help="Keep running, printing new jobs as they finish")
+    parser.add_argument(
+        "--interval", type=int, default=DEFAULT_INTERVAL,
+        help="Follow mode: seconds between sacct queries "
+             f"(default: {DEFAULT_INTERVAL})")
+    parser.add_argument(
+        "--overlap", type=int, default=DEFAULT_OVERLAP,
+        help="Follow mode: seconds each query overlaps the previous one "
+             f"(default: {DEFAULT_OVERLAP})")
+    parser.add_argument(
+        "--output", metavar="FILE",
+        help="Append output to this file rather than stdout")
+    parser.add_argument(
+        "--compress", choices=jsonlines.COMPRESSORS,
+        help="Compress the output file")
+    parser.add_argument(
+        "--max-bytes", type=int, default=0,
+        help="Rotate the output file once it is larger than this "
+             "(default: never)")
+    parser.add_argument(
+        "--backup-count", type=int, default=jsonlines.DEFAULT_BACKUP_COUNT,
+        help="Rotated output files to keep "
+             f"(default: {jsonlines.DEFAULT_BACKUP_COUNT})")
+    parser.add_argument(
+        "--encoder", choices=list(jsonlines.ENCODERS),
+        help="JSON encoder (default: the fastest available)")
+    parser.add_argument(
+        "--occupancy", type=int, metavar="SECONDS",
+        help="Print per-node and per-partition utilisation timelines at "
+             "this resolution instead of jobs (needs NumPy)")
+    parser.add_argument(
+        "--input", metavar="FILE",
+        help="Occupancy mode: read jobs from slurm-stats output ('-' for "
+             "stdin) rather than running sacct")
+    parser.add_argument(
+        "--starttime", help="Occupancy mode: start of the timeline "
+                            "(default: a year ago, or the first job)")
+    parser.add_argument(
+        "--endtime", help="Occupancy mode: end of the timeline "
+                          "(default: now, or the last job)")
+    args = parser.parse_args(argv)
+    if args.compress and not args.output:
+        parser.error("--compress needs --output")
+    if args.clusters is not None:
+        args.clusters = [c for c in args.clusters.split(",") if c]
+        if not args.clusters:
+            parser.error("--clusters needs at least one cluster name")
+        if args.follow:
+            parser.error("--clusters can't be used with --follow")
+        if args.occupancy:
+            parser.error("--clusters can't be used with --occupancy")
+    return args
+
+
+def to_epoch(time_str):
+    """Convert a Slurm date string to epoch ms, as for StartEpoch."""
+    return int(datetime.datetime.strptime(
+        time_str, SLURM_DATE_FORMAT).timestamp() * 1000)
+
+
+def print_occupancy(args, writer):
+    """Print occupancy timelines for jobs from sacct or a file."""
+    if args.input:
+        f = sys.stdin if args.input == "-" else open(args.input)
+        with f:
+            items = [json.loads(line) for line in f if line.strip()]
+        start = (to_epoch(args.starttime) if args.starttime else
+                 min((i["StartEpoch"] for i in items if "StartEpoch" in i),
+                     default=0))
+        end = (to_epoch(args.endtime) if args.endtime else
+               max((i["EndEpoch"] for i in items if "EndEpoch" in i),
+                   default=start))
+    else:
+        now = datetime.datetime.utcnow()
+        start_str = args.starttime or (
+            now - datetime.timedelta(days=365)).strftime(SLURM_DATE_FORMAT)
+        end_str = args.endtime or now.strftime(SLURM_DATE_FORMAT)
+        lines = run_sacct(start_str, end_str)
+        items = parse_lines(lines, {})
+        if items is None:
+            print(lines)
+            exit(-1)
+        start, end = to_epoch(start_str), to_epoch(end_str)
+
+    for record in occupancy.records(items, start, end, args.occupancy):
+        writer.write(record)
+
+
+def fetch(writer):
+    """Print jobs finished since the last run, and update the checkpoint."""
+    # Work out starttime and endtime
+    now = datetime.datetime.utcnow()
+    end_str = now.strftime(SLURM_DATE_FORMAT)
+    start_str = read_start()
+
+    # print(" ".join(args))
+    lines = run_sacct(start_str, end_str)
+    items = parse_lines(lines)
+
+    # Try to output any errors we might have hit
+    if items is None:
+        print(lines)
+        exit(-1)
+
+    for item in items:
+        writer.write(item)
+    writer.flush()
 
     # Write out timestamp, so we know where to start next time
-    next = now + datetime.timedelta(seconds=1)
-    next_str = next.strftime(SLURM_DATE_FORMAT)
-    with open(TIMESTAMP_FILE, 'w') as f:
-        f.write(next_str)
+    write_start(now + datetime.timedelta(seconds=1))
 
     # print(len(items))
 
     # Do a per node summary of job ids
     # TODO(johngarbutt): arguments to toggle this output
-    import collections
     node_jobs = collections.defaultdict(list)
     jobs = {}
     for job in items:
@@ -127,5 +395,27 @@ def main():
     #    print(node_info)
 
 
+def main():
+    metrics.configure("slurm-stats")
+    args = parse_args()
+    # ujson formats floats differently, so keep occupancy on the stdlib
+    encoder = jsonlines.get_encoder(
+        "json" if args.occupancy else args.encoder)
+    with jsonlines.open_output(args.output, args.compress, args.max_bytes,
+                               args.backup_count, encoder) as writer:
+        if args.occupancy:
+            print_occupancy(args, writer)
+        elif args.clusters:
+            if fetch_clusters(args.clusters, writer):
+                exit(-1)
+        elif args.follow:
+            try:
+                follow(args.interval, args.overlap, writer)
+            except KeyboardInterrupt:
+                pass
+        else:
+            fetch(writer)
+
+
 if __name__ == "__main__":
     main()
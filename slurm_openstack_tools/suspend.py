@@ -26,6 +26,11 @@ If a file with the nodename exists in the Slurm control daemons spool directory
 delete. Otherwise, this will attempt to delete the instance by name which
 requires that the name is unique.
 
+A Neutron port ID on the second line of the file (see SLURM_OPENSTACK_PORTS
+for the resume program) is deleted along with the instance, unless
+SLURM_OPENSTACK_PORTS=reuse is set, in which case the port is kept for the
+node's next resume.
+
 Output and exceptions are written to the syslog.
 
 [1]: https://slurm.schedmd.com/slurm.conf.html#OPT_SuspendProgram [2]:
@@ -41,6 +46,12 @@ import sys
 
 import openstack
 
+from slurm_openstack_tools import metrics
+from slurm_openstack_tools import throttle
+from slurm_openstack_tools import tracing
+
+PORTS_ENV = 'SLURM_OPENSTACK_PORTS'
+
 # configure logging to syslog - by default only "info" and above
 # categories appear
 logger = logging.getLogger("syslogger")
@@ -52,7 +63,7 @@ logger.addHandler(handler)
 
 def get_statesavelocation():
     """Return the path for Slurm's StateSaveLocation """
-    scontrol = subprocess.run(
+    scontrol = metrics.run(
         ['scontrol', 'show', 'config'],
         stdout=subprocess.PIPE, universal_newlines=True)
     for line in scontrol.stdout.splitlines():
@@ -62,15 +73,15 @@ def get_statesavelocation():
 
 
 def expand_nodes(hostlist_expr):
-    scontrol = subprocess.run(
+    scontrol = metrics.run(
         ['scontrol', 'show', 'hostnames', hostlist_expr],
         stdout=subprocess.PIPE, universal_newlines=True)
     return scontrol.stdout.strip().split('\n')
 
 
 def delete_server(conn, name):
-    server = conn.compute.find_server(name)
-    conn.compute.delete_server(server)
+    server = throttle.call('find_server', conn.compute.find_server, name)
+    throttle.call('delete_server', conn.compute.delete_server, server)
 
 
 def suspend():
@@ -78,27 +89,38 @@ def suspend():
     logger.info(f"Slurmctld invoked suspend {hostlist_expr}")
     remove_nodes = expand_nodes(hostlist_expr)
 
-    conn = openstack.connection.from_config()
+    with tracing.span('auth'):
+        conn = openstack.connection.from_config()
     logger.info(f"Got openstack connection {conn}")
 
     for node in remove_nodes:
-        instance_id = False
-        statedir = get_statesavelocation()
-        instance_file = os.path.join(statedir, node)
-        try:
-            with open(instance_file) as f:
-                instance_id = f.readline().strip()
-        except FileNotFoundError:
-            logger.info(
-                f"no instance file found in {statedir} for node {node}")
-
-        logger.info(f"deleting node {instance_id or node}")
-        delete_server(conn, (instance_id or node))
+        with tracing.span('node', node=node):
+            instance_id = False
+            port_id = None
+            statedir = get_statesavelocation()
+            instance_file = os.path.join(statedir, node)
+            try:
+                with open(instance_file) as f:
+                    instance_id = f.readline().strip()
+                    port_id = f.readline().strip()
+            except FileNotFoundError:
+                logger.info(
+                    f"no instance file found in {statedir} for node {node}")
+
+            logger.info(f"deleting node {instance_id or node}")
+            delete_server(conn, (instance_id or node))
+            if port_id and os.environ.get(PORTS_ENV) != 'reuse':
+                logger.info(f"deleting port {port_id}")
+                throttle.call(
+                    'delete_port', conn.network.delete_port, port_id)
 
 
 def main():
+    metrics.configure('suspend')
+    tracing.configure('suspend')
     try:
-        suspend()
+        with tracing.span('suspend', hostlist=' '.join(sys.argv[1:])):
+            suspend()
     except BaseException:
         logger.exception('Exception in main:')
         raise
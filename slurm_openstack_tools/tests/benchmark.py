@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Scale benchmark for resume, suspend and rebuild against the simulator.
+
+Usage:
+
+    python -m slurm_openstack_tools.tests.benchmark [--nodes 10 100 1000]
+        [--tools resume suspend rebuild] [--latency SECONDS]
+        [--error-rate RATE] [--json]
+
+Reports wall time, OpenStack API calls, injected errors and peak API
+concurrency for each tool and hostlist size.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from slurm_openstack_tools import reboot
+from slurm_openstack_tools import resume
+from slurm_openstack_tools import suspend
+from slurm_openstack_tools.tests import fakes
+from slurm_openstack_tools import throttle
+
+TOOLS = ('resume', 'suspend', 'rebuild')
+
+
+def _run_resume(cloud, nodes, expr, slurm, workdir):
+    with mock.patch.object(sys, 'argv', ['resume', expr]):
+        resume.resume()
+
+
+def _run_suspend(cloud, nodes, expr, slurm, workdir):
+    for node in nodes:
+        srv = cloud.add_server(node)
+        with open(os.path.join(slurm.statedir, node), 'w') as f:
+            f.write(srv.id)
+    with mock.patch.object(sys, 'argv', ['suspend', expr]):
+        suspend.suspend()
+
+
+def _run_rebuild(cloud, nodes, expr, slurm, workdir):
+    hostvars_dir = os.path.join(workdir, 'hostvars')
+    for i, node in enumerate(nodes):
+        # Half the nodes are rebuilt onto a new image, the rest rebooted
+        srv = cloud.add_server(node, 'cirros' if i % 2 else 'rocky')
+        os.makedirs(os.path.join(hostvars_dir, node))
+        with open(os.path.join(hostvars_dir, node, 'hostvars.yml'), 'w') as f:
+            f.write('instance_id: %s\nimage_id: %s\n' % (
+                srv.id, cloud.images['rocky'].id))
+    with mock.patch.object(reboot, 'HOSTVARS_DIR', hostvars_dir), \
+            mock.patch.object(sys, 'argv', ['rebuild', ','.join(nodes)]):
+        try:
+            reboot.main()
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError('rebuild exited with %s' % e.code)
+
+
+RUNNERS = {
+    'resume': _run_resume,
+    'suspend': _run_suspend,
+    'rebuild': _run_rebuild,
+}
+
+
+def run(tool, count, latency=0.0, error_rate=0.0):
+    """Run one tool over `count` simulated nodes and return its stats."""
+    cloud = fakes.FakeCloud(
+        latency=latency, seed=count,
+        error_rates={op: (429, error_rate) for op in (
+            'create_server', 'delete_server', 'rebuild_server',
+            'reboot_server')})
+    nodes = ['compute-%d' % i for i in range(count)]
+    expr = 'compute-[0-%d]' % (count - 1)
+    with tempfile.TemporaryDirectory() as workdir, \
+            fakes.simulate(cloud, nodes, workdir) as slurm, \
+            mock.patch.object(throttle, '_caller', throttle.ApiCaller()), \
+            mock.patch.object(reboot, '_image_cache', {}):
+        started = time.monotonic()
+        RUNNERS[tool](cloud, nodes, expr, slurm, workdir)
+        wall = time.monotonic() - started
+    return {
+        'tool': tool,
+        'nodes': count,
+        'wall_time': round(wall, 3),
+        'api_calls': sum(cloud.calls.values()),
+        'api_errors': sum(cloud.errors.values()),
+        'peak_concurrency': cloud.peak_total,
+        'calls': dict(cloud.calls),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--tools', nargs='+', choices=TOOLS, default=TOOLS)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds of latency per API call')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability of a 429 from mutating calls')
+    parser.add_argument('--json', action='store_true',
+                        help='Print one JSON object per run')
+    args = parser.parse_args(argv)
+
+    # The tools log to syslog; keep benchmark output readable
+    syslogger = logging.getLogger('syslogger')
+    syslogger.handlers = [logging.NullHandler()]
+
+    if not args.json:
+        print('%-8s %6s %10s %9s %7s %5s' % (
+            'tool', 'nodes', 'wall (s)', 'calls', 'errors', 'peak'))
+    for tool in args.tools:
+        for count in args.nodes:
+            stats = run(tool, count, args.latency, args.error_rate)
+            if args.json:
+                print(json.dumps(stats))
+            else:
+                print('%-8s %6d %10.2f %9d %7d %5d' % (
+                    tool, count, stats['wall_time'], stats['api_calls'],
+                    stats['api_errors'], stats['peak_concurrency']))
+
+
+if __name__ == '__main__':
+    main()
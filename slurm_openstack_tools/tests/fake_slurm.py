@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fake `scontrol` and `sacct` executables for the simulator.
+
+This module is imported by the generated executables themselves, so it must
+stay cheap to import: no openstacksdk here.
+"""
+
+import json
+import os
+import stat
+import sys
+import textwrap
+import time
+
+from ClusterShell import NodeSet
+
+DEFAULT_FEATURES = ('image=cirros', 'flavor=m1.small', 'keypair=slurm',
+                    'network=slurm-net')
+
+SCRIPT = textwrap.dedent('''\
+    #!{python}
+    import json
+    import sys
+    sys.path.insert(0, {here!r})
+    import fake_slurm
+    with open({config!r}) as f:
+        config = json.load(f)
+    sys.exit(fake_slurm.{func}(config, sys.argv[1:]))
+    ''')
+
+SACCT_FIELDS = {
+    'jobid': 'JobID', 'jobidraw': 'JobIDRaw', 'cluster': 'Cluster',
+    'partition': 'Partition', 'account': 'Account', 'group': 'Group',
+    'gid': 'GID', 'user': 'User', 'uid': 'UID', 'submit': 'Submit',
+    'eligible': 'Eligible', 'start': 'Start', 'end': 'End',
+    'elapsed': 'Elapsed', 'elapsedraw': 'ElapsedRaw',
+    'exitcode': 'ExitCode', 'state': 'State', 'nnodes': 'NNodes',
+    'ncpus': 'NCPUS', 'reqcpus': 'ReqCPUS', 'reqmem': 'ReqMem',
+    'reqtres': 'ReqTRES', 'timelimit': 'Timelimit', 'nodelist': 'NodeList',
+    'jobname': 'JobName',
+}
+
+
+class SimulatedSlurm(object):
+    """Fake `scontrol` and `sacct` executables in `workdir`/bin.
+
+    nodes maps node names to {'features': [...], 'partitions': [...]}.
+    Every `scontrol update` is appended to `workdir`/scontrol-updates, and
+    sacct reports `sacct_jobs` synthetic completed jobs.
+    """
+
+    def __init__(self, workdir, nodes, sacct_jobs=0):
+        self.workdir = workdir
+        self.bindir = os.path.join(workdir, 'bin')
+        self.statedir = os.path.join(workdir, 'statesave')
+        self.updates = os.path.join(workdir, 'scontrol-updates')
+        os.makedirs(self.bindir, exist_ok=True)
+        os.makedirs(self.statedir, exist_ok=True)
+        config = os.path.join(workdir, 'slurm.json')
+        with open(config, 'w') as f:
+            json.dump({'nodes': nodes, 'statesave': self.statedir,
+                       'updates': self.updates,
+                       'sacct_jobs': sacct_jobs}, f)
+        for name, func in (('scontrol', 'fake_scontrol'),
+                           ('sacct', 'fake_sacct')):
+            path = os.path.join(self.bindir, name)
+            with open(path, 'w') as f:
+                f.write(SCRIPT.format(
+                    python=sys.executable, config=config, func=func,
+                    here=os.path.dirname(os.path.abspath(__file__))))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    def read_updates(self):
+        """Return the arguments of each `scontrol update` run so far."""
+        try:
+            with open(self.updates) as f:
+                return [line.split() for line in f.read().splitlines()]
+        except FileNotFoundError:
+            return []
+
+
+def make_nodes(nodes, features=DEFAULT_FEATURES, partitions=('compute',)):
+    """Return a SimulatedSlurm node definition for a list of node names."""
+    return {node: {'features': list(features),
+                   'partitions': list(partitions)} for node in nodes}
+
+
+def _expand(config, expr):
+    if not expr:
+        return list(config['nodes'])
+    return list(NodeSet.NodeSet(expr))
+
+
+def fake_scontrol(config, args):
+    if args[:2] == ['show', 'config']:
+        print('StateSaveLocation       = %s' % config['statesave'])
+    elif args[:2] == ['show', 'hostnames']:
+        print('\n'.join(_expand(config, args[2])))
+    elif args[:2] == ['show', 'node']:
+        for node in _expand(config, args[2] if len(args) > 2 else None):
+            info = config['nodes'].get(node)
+            if info is None:
+                continue
+            print('NodeName=%s Arch=x86_64 CoresPerSocket=1' % node)
+            print('   AvailableFeatures=%s' % ','.join(info['features']))
+            print('   ActiveFeatures=%s' % ','.join(info['features']))
+            print('   Partitions=%s' % ','.join(info['partitions']))
+            print('   State=IDLE+CLOUD')
+            print()
+    elif args[:1] == ['update']:
+        with open(config['updates'], 'a') as f:
+            f.write(' '.join(args[1:]) + '\n')
+    else:
+        print('scontrol: unsupported fake command %s' % args,
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+def _slurm_time(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epoch))
+
+
+def fake_sacct(config, args):
+    fields = args[args.index('--format') + 1].split(',')
+    cluster = args[args.index('-M') + 1] if '-M' in args else 'linux'
+    nodes = sorted(config['nodes'])
+    print('|'.join(SACCT_FIELDS[field] for field in fields))
+    for i in range(config['sacct_jobs']):
+        start = 1600000000 + i * 60
+        values = {
+            'jobid': str(i + 1), 'jobidraw': str(i + 1), 'cluster': cluster,
+            'partition': 'compute', 'account': '', 'group': 'users',
+            'gid': '1000', 'user': 'user', 'uid': '1000',
+            'submit': _slurm_time(start - 10),
+            'eligible': _slurm_time(start - 10),
+            'start': _slurm_time(start), 'end': _slurm_time(start + 600),
+            'elapsed': '00:10:00', 'elapsedraw': '600', 'exitcode': '0:0',
+            'state': 'COMPLETED', 'nnodes': '1', 'ncpus': '1',
+            'reqcpus': '1', 'reqmem': '500M',
+            'reqtres': 'billing=1,cpu=1,mem=500M,node=1',
+            'timelimit': '01:00:00',
+            'nodelist': nodes[i % len(nodes)] if nodes else 'None',
+            'jobname': 'job-%d' % i,
+        }
+        print('|'.join(values[field] for field in fields))
+    return 0
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A local OpenStack and Slurm simulator for exercising the tools.
+
+FakeCloud stands in for the parts of the Nova, Glance, Neutron and Keystone
+APIs the tools use, at the openstacksdk Connection level: FakeConnection
+offers the same proxy methods and returns real openstacksdk resources. Every
+call can be given a latency and can fail with injected HTTP errors (e.g. 429
+or 409), and servers move through BUILD/REBUILD/REBOOT to ACTIVE (or ERROR)
+after a configurable time. Call counts and peak concurrency are recorded.
+
+fake_slurm.SimulatedSlurm writes fake `scontrol` and `sacct` executables
+answering the queries the tools make for a configurable set of nodes.
+
+Use simulate() to run a tool against both, e.g.:
+
+    cloud = FakeCloud(latency=0.01)
+    with simulate(cloud, ['compute-0', 'compute-1'], workdir):
+        resume.resume()
+"""
+
+import collections
+import contextlib
+import os
+import random
+import threading
+import time
+import uuid
+from unittest import mock
+
+import openstack
+from openstack.compute.v2 import aggregate
+from openstack.compute.v2 import flavor
+from openstack.compute.v2 import keypair
+from openstack.compute.v2 import server
+from openstack.image.v2 import image
+from openstack.network.v2 import network
+from openstack.network.v2 import port
+
+from slurm_openstack_tools.tests import fake_slurm
+
+
+class FakeCloud(object):
+    """Simulated OpenStack services with latency and error injection.
+
+    latency: seconds added to every API call; latencies overrides it per
+        operation, e.g. {'create_server': 0.5}.
+    error_rates: {operation: (http_status, probability)} failures injected
+        at random, e.g. {'create_server': (429, 0.1)}.
+    boot_time: seconds a server spends in BUILD, REBUILD or REBOOT.
+    error_state_rate: probability a server ends in ERROR rather than ACTIVE.
+    """
+
+    def __init__(self, latency=0.0, latencies=None, error_rates=None,
+                 boot_time=0.0, error_state_rate=0.0, hypervisors=10,
+                 hosts_per_aggregate=5, page_size=1000, seed=None):
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.error_rates = dict(error_rates or {})
+        self.boot_time = boot_time
+        self.error_state_rate = error_state_rate
+        self.hypervisors = ['hv-%d' % i for i in range(hypervisors)]
+        self.page_size = page_size
+        self.random = random.Random(seed)
+
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.peak = collections.Counter()
+        self.total_in_flight = 0
+        self.peak_total = 0
+        self._injected = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+        self.servers = {}
+        self.ports = {}
+        self.precached = collections.defaultdict(set)
+        self.images = {}
+        self.flavors = {}
+        self.networks = {}
+        self.keypairs = {}
+        self.add_image('cirros')
+        self.add_image('rocky')
+        self.flavors['m1.small'] = flavor.Flavor(
+            id='flavor-m1.small', name='m1.small')
+        self.networks['slurm-net'] = network.Network(
+            id='net-slurm-net', name='slurm-net')
+        self.keypairs['slurm'] = keypair.Keypair(id='slurm', name='slurm')
+        self.aggregates = [
+            aggregate.Aggregate(
+                id=str(i), name='agg-%d' % i,
+                hosts=self.hypervisors[start:start + hosts_per_aggregate])
+            for i, start in enumerate(
+                range(0, hypervisors, hosts_per_aggregate))]
+
+    def add_image(self, name):
+        self.images[name] = image.Image(id='img-%s' % name, name=name)
+        return self.images[name]
+
+    def add_server(self, name, image_name='cirros', status='ACTIVE'):
+        """Create a server directly, without counting an API call."""
+        return self._new_server(name, self.images[image_name].id, status)
+
+    def inject(self, op, status, count=1, after=0, applied=False):
+        """Make `count` calls of `op` fail with `status`, after `after`.
+
+        If applied is set the calls take effect before failing, like a
+        request whose response was lost.
+        """
+        with self._lock:
+            self._injected[op].extend(
+                [(None, False)] * after + [(status, applied)] * count)
+
+    # -- simulation machinery ------------------------------------------------
+
+    def api(self, op, func, *args, **kwargs):
+        with self._lock:
+            self.calls[op] += 1
+            self.in_flight[op] += 1
+            self.total_in_flight += 1
+            self.peak[op] = max(self.peak[op], self.in_flight[op])
+            self.peak_total = max(self.peak_total, self.total_in_flight)
+            status, applied = None, False
+            if self._injected[op]:
+                status, applied = self._injected[op].popleft()
+            elif op in self.error_rates:
+                rate_status, rate = self.error_rates[op]
+                if self.random.random() < rate:
+                    status = rate_status
+        try:
+            delay = self.latencies.get(op, self.latency)
+            if delay:
+                time.sleep(delay)
+            if status is not None:
+                with self._lock:
+                    self.errors[op] += 1
+                if applied:
+                    func(*args, **kwargs)
+                raise openstack.exceptions.HttpException(
+                    message='Simulated %d for %s' % (status, op),
+                    http_status=status)
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight[op] -= 1
+                self.total_in_flight -= 1
+
+    def _new_server(self, name, image_id, status, networks=None):
+        server_id = str(uuid.uuid4())
+        host = self.hypervisors[len(self.servers) % len(self.hypervisors)]
+        record = {
+            'id': server_id, 'name': name, 'image_id': image_id,
+            'compute_host': host, 'status': status, 'task_state': None,
+            'ready_at': 0, 'final': 'ACTIVE', 'networks': networks or [],
+        }
+        with self._lock:
+            self.servers[server_id] = record
+        if status != 'ACTIVE':
+            self._transition(record, status)
+        return self._resource(record)
+
+    def _transition(self, record, status):
+        task_states = {'BUILD': 'spawning', 'REBUILD': 'rebuilding',
+                       'REBOOT': 'rebooting'}
+        final = 'ACTIVE'
+        if self.random.random() < self.error_state_rate:
+            final = 'ERROR'
+        with self._lock:
+            record.update(status=status, task_state=task_states[status],
+                          ready_at=time.monotonic() + self.boot_time,
+                          final=final)
+
+    def _resource(self, record):
+        with self._lock:
+            if record['task_state'] and time.monotonic() >= record['ready_at']:
+                record.update(status=record['final'], task_state=None)
+            addresses = {}
+            for port_id in record['networks']:
+                fixed_ip = self.ports[port_id].fixed_ips[0]['ip_address']
+                addresses.setdefault('slurm-net', []).append(
+                    {'addr': fixed_ip, 'version': 4})
+            return server.Server(
+                id=record['id'], name=record['name'],
+                image={'id': record['image_id']},
+                status=record['status'], task_state=record['task_state'],
+                compute_host=record['compute_host'], addresses=addresses)
+
+    def _find_record(self, name_or_id):
+        if name_or_id in self.servers:
+            return self.servers[name_or_id]
+        matches = [r for r in self.servers.values()
+                   if r['name'] == name_or_id]
+        if len(matches) > 1:
+            raise openstack.exceptions.DuplicateResource(
+                'More than one server named %s' % name_or_id)
+        return matches[0] if matches else None
+
+    def _server_id(self, value):
+        return getattr(value, 'id', value)
+
+    def create_port(self, network_id, name, device_id=''):
+        with self._lock:
+            count = len(self.ports)
+            address = '10.%d.%d.%d' % (
+                count // 65536 % 256, count // 256 % 256, count % 256 + 1)
+            new_port = port.Port(
+                id=str(uuid.uuid4()), name=name, network_id=network_id,
+                device_id=device_id, fixed_ips=[{'ip_address': address}])
+            self.ports[new_port.id] = new_port
+        return new_port
+
+
+def _find(cloud, op, collection, name_or_id):
+    def find():
+        for item in collection.values():
+            if name_or_id in (item.id, item.name):
+                return item
+        return None
+    return cloud.api(op, find)
+
+
+class FakeCompute(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def find_image(self, name_or_id):
+        return _find(self.cloud, 'find_image', self.cloud.images, name_or_id)
+
+    def find_flavor(self, name_or_id):
+        return _find(self.cloud, 'find_flavor', self.cloud.flavors,
+                     name_or_id)
+
+    def find_keypair(self, name_or_id):
+        return _find(self.cloud, 'find_keypair', self.cloud.keypairs,
+                     name_or_id)
+
+    def create_server(self, name, image_id, flavor_id, networks,
+                      key_name=None):
+        cloud = self.cloud
+
+        def create():
+            ports = []
+            for net in networks:
+                if 'port' in net:
+                    ports.append(net['port'])
+                else:
+                    ports.append(
+                        cloud.create_port(net['uuid'], name + '-auto').id)
+            srv = cloud._new_server(name, image_id, 'BUILD', networks=ports)
+            for port_id in ports:
+                cloud.ports[port_id].device_id = srv.id
+            return srv
+        return cloud.api('create_server', create)
+
+    def find_server(self, name_or_id):
+        def find():
+            record = self.cloud._find_record(name_or_id)
+            return self.cloud._resource(record) if record else None
+        return self.cloud.api('find_server', find)
+
+    def get_server(self, server_id):
+        def get():
+            record = self.cloud.servers.get(self.cloud._server_id(server_id))
+            if record is None:
+                raise openstack.exceptions.ResourceNotFound(
+                    'No server %s' % server_id)
+            return self.cloud._resource(record)
+        return self.cloud.api('get_server', get)
+
+    def delete_server(self, value):
+        cloud = self.cloud
+
+        def delete():
+            record = cloud.servers.pop(cloud._server_id(value), None)
+            if record is None:
+                raise openstack.exceptions.ResourceNotFound(
+                    'No server %s' % value)
+            for port_id in record['networks']:
+                if cloud.ports[port_id].name == record['name'] + '-auto':
+                    del cloud.ports[port_id]
+                else:
+                    cloud.ports[port_id].device_id = ''
+        return cloud.api('delete_server', delete)
+
+    def reboot_server(self, value, reboot_type='SOFT'):
+        cloud = self.cloud
+
+        def reboot():
+            cloud._transition(cloud.servers[cloud._server_id(value)],
+                              'REBOOT')
+        return cloud.api('reboot_server', reboot)
+
+    def rebuild_server(self, value, image):
+        cloud = self.cloud
+
+        def rebuild():
+            record = cloud.servers[cloud._server_id(value)]
+            record['image_id'] = getattr(image, 'id', image)
+            cloud._transition(record, 'REBUILD')
+            return cloud._resource(record)
+        return cloud.api('rebuild_server', rebuild)
+
+    def servers(self, details=True, **query):
+        cloud = self.cloud
+        records = list(cloud.servers.values())
+        for start in range(0, max(len(records), 1), cloud.page_size):
+            page = cloud.api(
+                'list_servers',
+                lambda: [cloud._resource(r)
+                         for r in records[start:start + cloud.page_size]])
+            for item in page:
+                yield item
+
+    def aggregates(self):
+        return self.cloud.api('list_aggregates',
+                              lambda: list(self.cloud.aggregates))
+
+    def aggregate_precache_images(self, value, images):
+        def precache():
+            agg = [a for a in self.cloud.aggregates
+                   if a.id == getattr(value, 'id', value)][0]
+            for host in agg.hosts:
+                self.cloud.precached[host].update(images)
+        return self.cloud.api('precache_images', precache)
+
+
+class FakeImage(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_image(self, image_id):
+        def get():
+            for item in self.cloud.images.values():
+                if item.id == image_id:
+                    return item
+            raise openstack.exceptions.ResourceNotFound(
+                'No image %s' % image_id)
+        return self.cloud.api('get_image', get)
+
+
+class FakeNetwork(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def find_network(self, name_or_id):
+        return _find(self.cloud, 'find_network', self.cloud.networks,
+                     name_or_id)
+
+    def create_ports(self, data):
+        cloud = self.cloud
+
+        def create():
+            return [cloud.create_port(attrs['network_id'], attrs['name'])
+                    for attrs in data]
+        return iter(cloud.api('create_ports', create))
+
+    def ports(self, **query):
+        cloud = self.cloud
+
+        def list_ports():
+            with cloud._lock:
+                return [p for p in cloud.ports.values()
+                        if all(p[k] == v for k, v in query.items())]
+        return iter(cloud.api('list_ports', list_ports))
+
+    def delete_port(self, value, ignore_missing=True):
+        cloud = self.cloud
+
+        def delete():
+            with cloud._lock:
+                cloud.ports.pop(getattr(value, 'id', value), None)
+        cloud.api('delete_port', delete)
+
+
+class FakeConnection(object):
+    """Stands in for openstack.connection.Connection."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        cloud.api('authenticate', lambda: None)
+        self.compute = FakeCompute(cloud)
+        self.image = FakeImage(cloud)
+        self.network = FakeNetwork(cloud)
+
+    def get_server(self, server_id):
+        try:
+            return self.compute.get_server(server_id)
+        except openstack.exceptions.ResourceNotFound:
+            return None
+
+    def rebuild_server(self, server_id, image_id):
+        return self.compute.rebuild_server(server_id, image_id)
+
+
+@contextlib.contextmanager
+def simulate(cloud, nodes, workdir, sacct_jobs=0):
+    """Point the tools at `cloud` and a SimulatedSlurm for `nodes`."""
+    if not isinstance(nodes, dict):
+        nodes = fake_slurm.make_nodes(nodes)
+    slurm = fake_slurm.SimulatedSlurm(workdir, nodes, sacct_jobs=sacct_jobs)
+    path = slurm.bindir + os.pathsep + os.environ.get('PATH', '')
+    with mock.patch.dict(os.environ, {'PATH': path}), \
+            mock.patch.object(openstack.connection, 'from_config',
+                              lambda *args, **kwargs: FakeConnection(cloud)):
+        yield slurm
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import gzip
+import io
+import json
+import os
+import sys
+from unittest import mock
+
+import fixtures
+from oslotest import base
+import testtools
+
+from slurm_openstack_tools import jsonlines
+from slurm_openstack_tools import sacct
+from slurm_openstack_tools.tests import fake_slurm
+
+RECORDS = [
+    {"JobID": "%d" % i, "NNodes": i, "NodeList": "c[1-%d]" % (i + 1),
+     "JobName": "caf\xe9/run.sh", "AllNodes": ["c1"]}
+    for i in range(50)]
+EXPECTED = "".join(json.dumps(record) + "\n" for record in RECORDS)
+
+
+class TestJsonLines(base.BaseTestCase):
+    def setUp(self):
+        super(TestJsonLines, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(self.tmpdir, "jobs.json")
+
+    def test_writer_matches_json_dumps(self):
+        stream = io.StringIO()
+        with mock.patch.object(stream, "write", wraps=stream.write) as write:
+            with jsonlines.Writer(stream, buffer_size=1000) as writer:
+                for record in RECORDS:
+                    writer.write(record)
+        self.assertEqual(EXPECTED, stream.getvalue())
+        self.assertLess(write.call_count, len(RECORDS) / 5)
+
+    def test_get_encoder_checks_fast_encoders(self):
+        def broken():
+            return lambda obj: json.dumps(obj, separators=(",", ":"))
+
+        def raw_delete():
+            # As ujson does
+            return lambda obj: json.dumps(obj).replace("\\u007f", "\x7f")
+        for factory in (broken, raw_delete):
+            encoders = collections.OrderedDict(
+                [("fast", factory), ("json", jsonlines._json_encoder)])
+            with mock.patch.object(jsonlines, "ENCODERS", encoders):
+                encode = jsonlines.get_encoder()
+            self.assertEqual(json.dumps({"JobName": "a\x7f"}),
+                             encode({"JobName": "a\x7f"}))
+
+    @mock.patch.object(jsonlines, "ujson", None)
+    def test_get_encoder_missing(self):
+        self.assertRaises(RuntimeError, jsonlines.get_encoder, "ujson")
+        self.assertEqual(json.dumps(RECORDS[1]),
+                         jsonlines.get_encoder()(RECORDS[1]))
+
+    def test_gzip_appends_members(self):
+        for records in (RECORDS[:10], RECORDS[10:]):
+            with jsonlines.open_output(self.path, "gzip") as writer:
+                for record in records:
+                    writer.write(record)
+        with gzip.open(self.path, "rt") as f:
+            self.assertEqual(EXPECTED, f.read())
+
+    @testtools.skipUnless(jsonlines.zstandard, "zstandard is not installed")
+    def test_zstd(self):
+        with jsonlines.open_output(self.path, "zstd") as writer:
+            for record in RECORDS:
+                writer.write(record)
+        with open(self.path, "rb") as f:
+            reader = jsonlines.zstandard.ZstdDecompressor().stream_reader(f)
+            self.assertEqual(EXPECTED, reader.read().decode())
+
+    def test_rotation(self):
+        output = jsonlines.RotatingFile(
+            self.path, max_bytes=100, backup_count=2)
+        for i in range(4):
+            output.write("%d\n" % i * 60)
+            output.flush()
+        output.close()
+        self.assertEqual(
+            ["jobs.json", "jobs.json.1", "jobs.json.2"],
+            sorted(os.listdir(self.tmpdir)))
+        with open(self.path + ".1") as f:
+            self.assertEqual("3\n" * 60, f.read())
+        with open(self.path) as f:
+            self.assertEqual("", f.read())
+
+    def test_rotation_between_flushes(self):
+        output = jsonlines.RotatingFile(
+            self.path, max_bytes=1000, backup_count=1)
+        with jsonlines.Writer(output, buffer_size=500,
+                              close_stream=True) as writer:
+            for record in RECORDS:
+                writer.write(record)
+            self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertLess(os.path.getsize(self.path + ".1"), 1600)
+
+    def test_main_with_output(self):
+        slurm = fake_slurm.SimulatedSlurm(
+            self.tmpdir, fake_slurm.make_nodes(["c0"]), sacct_jobs=3)
+        self.useFixture(fixtures.EnvironmentVariable(
+            "PATH", slurm.bindir + os.pathsep + os.environ["PATH"]))
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.sacct.TIMESTAMP_FILE",
+            os.path.join(self.tmpdir, "lasttimestamp")))
+        argv = ["slurm-stats", "--output", self.path + ".gz",
+                "--compress", "gzip"]
+        with mock.patch.object(sys, "argv", argv):
+            sacct.main()
+        with gzip.open(self.path + ".gz", "rt") as f:
+            items = [json.loads(line) for line in f]
+        self.assertEqual(["1", "2", "3"], [item["JobID"] for item in items])
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import subprocess
+from unittest import mock
+
+import fixtures
+from oslotest import base
+
+from slurm_openstack_tools import metrics
+
+
+class TestMetrics(base.BaseTestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.metrics._samples", {}))
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.metrics._tool", "resume"))
+        self.metrics_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_observe_api_call(self):
+        with metrics.partition("compute"):
+            metrics.observe_api_call("create_server", 0.3, True)
+        metrics.observe_api_call("create_server", 0.01, False)
+        samples = metrics._samples
+        self.assertEqual(1, samples[(
+            "slurm_openstack_api_call_duration_seconds_count",
+            '{tool="resume",operation="create_server",partition="compute"}')])
+        self.assertEqual(1, samples[(
+            "slurm_openstack_api_call_duration_seconds_bucket",
+            '{tool="resume",operation="create_server",partition="compute",'
+            'le="0.5"}')])
+        self.assertEqual(0, samples[(
+            "slurm_openstack_api_call_duration_seconds_bucket",
+            '{tool="resume",operation="create_server",partition="compute",'
+            'le="0.25"}')])
+        self.assertEqual(1, samples[(
+            "slurm_openstack_api_calls_total",
+            '{tool="resume",operation="create_server",partition="",'
+            'result="error"}')])
+
+    @mock.patch.object(subprocess, "run")
+    def test_run(self, mock_run):
+        mock_run.return_value.returncode = 1
+        metrics.run(["scontrol", "show", "config"], stdout=subprocess.PIPE)
+        mock_run.assert_called_once_with(
+            ["scontrol", "show", "config"], stdout=subprocess.PIPE)
+        self.assertEqual(1, metrics._samples[(
+            "slurm_openstack_commands_total",
+            '{tool="resume",operation="scontrol show",partition="",'
+            'result="error"}')])
+
+    def test_write_accumulates(self):
+        metrics.observe_command("sacct", 1.5, True)
+        metrics.write(self.metrics_dir)
+        metrics.observe_command("sacct", 2.0, True)
+        metrics.write(self.metrics_dir)
+        path = os.path.join(self.metrics_dir, "slurm_openstack_resume.prom")
+        with open(path) as f:
+            content = f.read()
+        self.assertIn(
+            "# TYPE slurm_openstack_command_duration_seconds histogram\n",
+            content)
+        self.assertIn(
+            'slurm_openstack_command_duration_seconds_sum{tool="resume",'
+            'operation="sacct",partition=""} 3.5\n', content)
+        self.assertIn(
+            'slurm_openstack_commands_total{tool="resume",operation="sacct",'
+            'partition="",result="success"} 2.0\n', content)
+        buckets = [line.split('le="')[1].split('"')[0]
+                   for line in content.splitlines() if "_bucket{" in line]
+        self.assertEqual(
+            ["0.01", "0.025", "0.05", "0.1", "0.25", "0.5", "1.0", "2.5",
+             "5.0", "10.0", "30.0", "60.0", "120.0", "+Inf"], buckets)
+        self.assertIn(
+            'slurm_openstack_command_duration_seconds_bucket{tool="resume",'
+            'operation="sacct",partition="",le="1.0"} 0.0\n', content)
+        self.assertEqual(["slurm_openstack_resume.prom",
+                          "slurm_openstack_resume.prom.lock"],
+                         sorted(os.listdir(self.metrics_dir)))
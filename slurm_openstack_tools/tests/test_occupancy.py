@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import io
+import json
+import os
+import sys
+from unittest import mock
+
+import fixtures
+from oslotest import base
+import testtools
+
+from slurm_openstack_tools import occupancy
+from slurm_openstack_tools import sacct
+
+
+def job(nodes, start, end, partition="p"):
+    return {"AllNodes": nodes, "Partition": partition,
+            "StartEpoch": start * 1000, "EndEpoch": end * 1000}
+
+
+@testtools.skipUnless(occupancy.np, "NumPy is not installed")
+class TestOccupancy(base.BaseTestCase):
+    def timelines(self, items, start, end, resolution):
+        nodes, partitions = occupancy.timelines(
+            items, start * 1000, end * 1000, resolution)
+        return ({k: v.tolist() for k, v in nodes.items()},
+                {k: v.tolist() for k, v in partitions.items()})
+
+    def test_timelines(self):
+        nodes, partitions = self.timelines([
+            job(["a"], 0, 15),
+            job(["b"], 0, 10),
+        ], 0, 30, 10)
+        self.assertEqual({"a": [1.0, 0.5, 0.0], "b": [1.0, 0.0, 0.0]}, nodes)
+        self.assertEqual({"p": [1.0, 0.25, 0.0]}, partitions)
+
+    def test_overlapping_jobs_count_once(self):
+        nodes, _ = self.timelines([
+            job(["a"], 0, 8),
+            job(["a"], 4, 12),
+            job(["a"], 5, 6),
+            job(["a"], 16, 18),
+        ], 0, 20, 10)
+        self.assertEqual({"a": [1.0, 0.4]}, nodes)
+
+    def test_clipped_to_range(self):
+        nodes, _ = self.timelines([
+            job(["a", "b"], -100, 5),
+            job(["b"], 15, 100),
+            job(["c"], 50, 60),
+        ], 0, 20, 10)
+        self.assertEqual({"a": [0.5, 0.0], "b": [0.5, 0.5],
+                          "c": [0.0, 0.0]}, nodes)
+
+    def test_partitions_average_member_nodes(self):
+        _, partitions = self.timelines([
+            job(["a"], 0, 10, "p"),
+            job(["b"], 0, 10, "q"),
+            job(["c"], 0, 5, "q"),
+        ], 0, 10, 10)
+        self.assertEqual({"p": [1.0], "q": [0.75]}, partitions)
+
+    def test_chunked_nodes(self):
+        items = [job(["n%d" % (i % 7)], i, i + 3 + i % 4) for i in range(40)]
+        expected = self.timelines(items, 0, 50, 5)
+        with mock.patch.object(occupancy, "CHUNK_NODES", 3):
+            self.assertEqual(expected, self.timelines(items, 0, 50, 5))
+
+    def test_skips_unusable_jobs(self):
+        items = [{"AllNodes": ["a"], "StartEpoch": 0},
+                 {"StartEpoch": 0, "EndEpoch": 1000},
+                 job(["a"], 5, 5)]
+        self.assertEqual(({}, {}),
+                         self.timelines(items, 0, 10, 10))
+
+    def test_main_with_input(self):
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tmpdir, "jobs.json")
+        with open(path, "w") as f:
+            for item in [job(["a"], 0, 15), job(["b"], 0, 10)]:
+                f.write(json.dumps(item) + "\n")
+        stdout = io.StringIO()
+        self.useFixture(fixtures.MonkeyPatch("sys.stdout", stdout))
+        argv = ["slurm-stats", "--occupancy", "10", "--input", path]
+        with mock.patch.object(sys, "argv", argv):
+            sacct.main()
+        records = [json.loads(line)
+                   for line in stdout.getvalue().splitlines()]
+        self.assertEqual(["a", "b", "p"],
+                         [r.get("Node", r.get("Partition")) for r in records])
+        self.assertEqual([1.0, 0.5], records[0]["Utilisation"])
+        self.assertEqual(0.75, records[0]["MeanUtilisation"])
+        self.assertEqual(10, records[2]["Resolution"])
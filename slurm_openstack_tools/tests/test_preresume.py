@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import subprocess
+from unittest import mock
+
+from oslotest import base
+
+from slurm_openstack_tools import preresume
+
+SQUEUE = """\
+10|compute|(null)|2|Resources
+11|compute,gpu|gpu&big|1|Priority
+12|compute|(null)|1|Dependency
+13|compute|a|b|1|Resources
+"""
+
+SINFO = """\
+c1|compute*|image=rocky,big|idle
+c2|compute*|image=rocky|idle~
+c3|compute*|image=rocky|idle~
+c3|gpu|image=rocky|idle~
+g1|gpu|gpu,big|idle~
+g2|gpu|gpu,big|alloc#
+"""
+
+
+def node(state, partitions=("compute",), features=()):
+    return {"partitions": set(partitions), "features": set(features),
+            "state": state}
+
+
+def job(nodes, partitions=("compute",), features=None, job_id="1"):
+    return {"id": job_id, "partitions": set(partitions),
+            "features": set(features or ()), "nodes": nodes}
+
+
+class TestPreresume(base.BaseTestCase):
+    def setUp(self):
+        super(TestPreresume, self).setUp()
+        self.nodes = {
+            "c1": node("idle"),
+            "c2": node("idle~"),
+            "c3": node("idle~"),
+            "c4": node("idle~", features=["big"]),
+            "c5": node("alloc"),
+            "g1": node("idle~", partitions=["gpu"]),
+        }
+
+    def test_parse_constraint(self):
+        self.assertEqual(set(), preresume.parse_constraint("(null)"))
+        self.assertEqual({"a", "b"}, preresume.parse_constraint("a&b"))
+        self.assertIsNone(preresume.parse_constraint("a|b"))
+        self.assertIsNone(preresume.parse_constraint("[a*2&b]"))
+
+    @mock.patch.object(preresume.metrics, "run")
+    def test_get_pending_jobs(self, mock_run):
+        mock_run.return_value.stdout = SQUEUE
+        jobs = preresume.get_pending_jobs()
+        self.assertEqual([
+            {"id": "10", "partitions": {"compute"}, "features": set(),
+             "nodes": 2},
+            {"id": "11", "partitions": {"compute", "gpu"},
+             "features": {"gpu", "big"}, "nodes": 1},
+        ], jobs)
+
+    @mock.patch.object(preresume.metrics, "run")
+    def test_get_nodes(self, mock_run):
+        mock_run.return_value.stdout = SINFO
+        nodes = preresume.get_nodes()
+        self.assertEqual(
+            node("idle~", ["compute", "gpu"], ["image=rocky"]), nodes["c3"])
+        self.assertEqual(
+            node("idle", ["compute"], ["image=rocky", "big"]), nodes["c1"])
+
+    def test_plan_uses_idle_nodes_first(self):
+        self.assertEqual(["c2"], preresume.plan([job(2)], self.nodes))
+        self.assertEqual(
+            ["c2", "c3"], preresume.plan([job(1), job(2)], self.nodes))
+
+    def test_plan_matches_features(self):
+        jobs = [job(1, features=["big"]), job(1, features=["big"])]
+        self.assertEqual(["c4"], preresume.plan(jobs, self.nodes))
+        # A constraint that couldn't be parsed matches any node
+        unparsed = job(2, features=["big"])
+        unparsed["features"] = None
+        self.assertEqual(["c2"], preresume.plan([unparsed], self.nodes))
+
+    def test_plan_skips_unsatisfiable_jobs(self):
+        self.assertEqual(
+            ["g1"], preresume.plan([job(10), job(1, ["gpu"])], self.nodes))
+
+    def test_plan_limits(self):
+        jobs = [job(1, job_id=str(i)) for i in range(4)]
+        self.assertEqual(
+            ["c2", "c3"], preresume.plan(jobs, self.nodes, max_nodes=2))
+        self.nodes["g2"] = node("idle#", partitions=["gpu"])
+        self.assertEqual(
+            ["c2"], preresume.plan(jobs, self.nodes, max_powering=2))
+        self.assertEqual(
+            [], preresume.plan(jobs, self.nodes, partitions={"gpu"}))
+
+    @mock.patch.object(preresume.metrics, "run")
+    def test_cycle(self, mock_run):
+        outputs = {"squeue": SQUEUE, "sinfo": SINFO, "scontrol": ""}
+
+        def run(args, **kwargs):
+            return subprocess.CompletedProcess(
+                args, 0, stdout=outputs[args[0]])
+        mock_run.side_effect = run
+
+        args = preresume.parse_args(["--once"])
+        self.assertEqual(["c2", "g1"], preresume.cycle(args))
+        mock_run.assert_called_with(
+            ["scontrol", "update", "nodename=c2,g1", "state=power_up"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+
+        mock_run.reset_mock()
+        args = preresume.parse_args(["--once", "--dry-run"])
+        self.assertEqual(["c2", "g1"], preresume.cycle(args))
+        self.assertEqual(2, mock_run.call_count)
@@ -17,13 +17,37 @@
 
 import os
 from os import path
+import subprocess
+import time
 from unittest import mock
 
+import fixtures
+from openstack.compute.v2 import aggregate
+from openstack.compute.v2 import server
+from openstack import exceptions
 from oslotest import base
 
 from slurm_openstack_tools import reboot
 
 
+def indexed(node, index=None):
+    """Stands in for get_hostvars, trusting the index."""
+    return index[node]
+
+
+def fake_process_nodes(*waves):
+    """Stands in for process_nodes, acting on server sN for node nN."""
+    outcomes = iter(waves)
+
+    def process_nodes(conn, wave, server_ids=None, **kwargs):
+        results = next(outcomes)
+        server_ids.update(
+            (node, "s" + node[1:]) for node, outcome in results.items()
+            if outcome in ("rebuild", "reboot"))
+        return results
+    return process_nodes
+
+
 class TestReboot(base.BaseTestCase):
     @mock.patch.object(path, "exists")
     def test_get_openstack_server_id_missing_file(self, mock_exists):
@@ -87,3 +111,269 @@ class TestReboot(base.BaseTestCase):
         reboot.rebuild_or_reboot()
         mock_exec.assert_called_once_with("reboot", ["reboot"])
         mock_id.assert_called_once_with()
+
+
+class TestProcessNodes(base.BaseTestCase):
+    @mock.patch.object(reboot, "process_node")
+    def test_process_nodes_continues_after_failure(self, mock_process):
+        error = ValueError("boom")
+
+        def process(conn, node, index, servers, server_ids):
+            if node == "n1":
+                raise error
+            return "reboot"
+
+        mock_process.side_effect = process
+        results = reboot.process_nodes("conn", ["n0", "n1", "n2"], workers=2)
+        self.assertEqual({"n0": "reboot", "n1": error, "n2": "reboot"},
+                         results)
+        self.assertEqual(3, mock_process.call_count)
+
+    @mock.patch.object(reboot, "process_node", return_value="reboot")
+    @mock.patch.object(reboot, "list_servers", return_value={"id": "s"})
+    def test_process_nodes_lists_servers_once(self, mock_list,
+                                              mock_process):
+        hostlist = [f"n{i}" for i in range(reboot.LIST_SERVERS_THRESHOLD + 1)]
+        reboot.process_nodes("conn", hostlist)
+        mock_list.assert_called_once_with("conn")
+        mock_process.assert_any_call("conn", "n0", None, {"id": "s"}, None)
+
+    @mock.patch.object(reboot, "process_nodes", return_value={"n0": "reboot"})
+    @mock.patch.object(reboot, "get_node_partitions")
+    @mock.patch.object(reboot.openstack.connection, "from_config")
+    def test_rebuild_labels_partitions(self, mock_config, mock_partitions,
+                                       mock_process):
+        mock_partitions.return_value = {"n0": ["compute"]}
+        self.assertEqual(0, reboot.rebuild(reboot.parse_args(["n0"])))
+        mock_process.assert_called_once_with(
+            mock_config.return_value, ["n0"], workers=reboot.DEFAULT_WORKERS,
+            index=None, partitions={"n0": ["compute"]})
+
+    def test_get_image_memoised(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.reboot._image_cache", {}))
+        conn = mock.Mock()
+        conn.image.get_image.side_effect = lambda image_id: image_id.upper()
+        self.assertEqual("A", reboot.get_image(conn, "a"))
+        self.assertEqual("A", reboot.get_image(conn, "a"))
+        self.assertEqual("B", reboot.get_image(conn, "b"))
+        self.assertEqual(2, conn.image.get_image.call_count)
+
+    def test_summarise(self):
+        results = {"n0": "rebuild", "n1": ValueError(), "n2": "skipped"}
+        self.assertEqual(1, reboot.summarise(results))
+        self.assertEqual(0, reboot.summarise({"n0": "reboot"}))
+
+    @mock.patch.object(reboot, "read_hostvars")
+    @mock.patch.object(reboot, "find_server")
+    @mock.patch.object(reboot, "rebuild_node", return_value=True)
+    @mock.patch.object(reboot, "reboot_node")
+    def test_process_node_actions(self, mock_reboot, mock_rebuild,
+                                  mock_find, mock_hostvars):
+        mock_hostvars.return_value = {"instance_id": "id", "image_id": "new"}
+        mock_find.return_value = server.Server(id="id", image={"id": "old"})
+        self.assertEqual("rebuild", reboot.process_node("conn", "n0"))
+        mock_find.return_value = server.Server(id="id", image={"id": "new"})
+        self.assertEqual("reboot", reboot.process_node("conn", "n0"))
+        mock_hostvars.return_value = None
+        self.assertEqual("skipped", reboot.process_node("conn", "n0"))
+
+    @mock.patch.object(reboot, "find_server")
+    @mock.patch.object(reboot, "reboot_node")
+    def test_process_node_uses_listing(self, mock_reboot, mock_find):
+        self.useFixture(fixtures.MockPatchObject(
+            reboot, "get_hostvars", side_effect=indexed))
+        listed = server.Server(id="id", image={"id": "img"})
+        index = {"n0": {"instance_id": "id", "image_id": "img"}}
+        server_ids = {}
+        self.assertEqual("reboot", reboot.process_node(
+            "conn", "n0", index=index, servers={"id": listed},
+            server_ids=server_ids))
+        self.assertEqual({"n0": "id"}, server_ids)
+        self.assertEqual(0, mock_find.call_count)
+        mock_reboot.assert_called_once_with("conn", listed)
+
+
+class TestHostvars(base.BaseTestCase):
+    def setUp(self):
+        super(TestHostvars, self).setUp()
+        self.hostvars_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.reboot.HOSTVARS_DIR", self.hostvars_dir))
+
+    def write_hostvars(self, node, content):
+        os.makedirs(os.path.join(self.hostvars_dir, node), exist_ok=True)
+        with open(os.path.join(self.hostvars_dir, node, "hostvars.yml"),
+                  "w") as f:
+            f.write(content)
+
+    def test_read_hostvars_missing(self):
+        self.assertIsNone(reboot.read_hostvars("n0"))
+
+    def test_read_hostvars_invalid_name(self):
+        self.assertRaises(ValueError, reboot.read_hostvars, "../n0")
+
+    def test_build_and_load_index(self):
+        self.write_hostvars("n0", "instance_id: a\nimage_id: i\nother: x\n")
+        self.write_hostvars("n1", "instance_id: b\nimage_id: i\n")
+        os.makedirs(os.path.join(self.hostvars_dir, "empty"))
+        index_file = os.path.join(self.hostvars_dir, "index.json")
+        self.assertEqual(2, reboot.build_index(index_file))
+        index = reboot.load_index(index_file)
+        self.assertEqual(["n0", "n1"], sorted(index))
+        self.assertEqual({"instance_id": "b", "image_id": "i"},
+                         {k: index["n1"][k] for k in reboot.INDEX_KEYS})
+
+    def test_get_hostvars_checks_index(self):
+        self.write_hostvars("n0", "instance_id: a\nimage_id: i\n")
+        index_file = os.path.join(self.hostvars_dir, "index.json")
+        reboot.build_index(index_file)
+        index = reboot.load_index(index_file)
+        index["n0"]["instance_id"] = "indexed"
+        with mock.patch.object(reboot, "read_hostvars") as mock_read:
+            self.assertEqual("indexed",
+                             reboot.get_hostvars("n0", index)["instance_id"])
+            self.assertEqual(0, mock_read.call_count)
+
+        self.write_hostvars("n0", "instance_id: a\nimage_id: new\n")
+        with mock.patch.object(reboot.logger, "warning") as mock_warning:
+            self.assertEqual({"instance_id": "a", "image_id": "new"},
+                             reboot.get_hostvars("n0", index))
+        self.assertIn("out of date", mock_warning.call_args[0][0])
+
+        os.remove(os.path.join(self.hostvars_dir, "n0", "hostvars.yml"))
+        self.assertIsNone(reboot.get_hostvars("n0", index))
+
+
+class TestRolling(base.BaseTestCase):
+    def test_plan_waves(self):
+        groups = {"a0": ["a"], "a1": ["a"], "a2": ["a"],
+                  "b0": ["b"], "ab": ["a", "b"]}
+        waves = reboot.plan_waves(["a0", "a1", "ab", "a2", "b0"], groups, 2)
+        self.assertEqual([["a0", "a1", "b0"], ["ab", "a2"]], waves)
+
+    def test_plan_waves_ungrouped(self):
+        waves = reboot.plan_waves(["n0", "n1", "n2"], {}, 2)
+        self.assertEqual([["n0", "n1"], ["n2"]], waves)
+
+    @mock.patch.object(subprocess, "run")
+    def test_get_node_partitions(self, mock_run):
+        mock_run.return_value.stdout = (
+            "NodeName=n0 Arch=x86_64 CoresPerSocket=1\n"
+            "   Partitions=compute,debug\n"
+            "NodeName=n1 Arch=x86_64 CoresPerSocket=1\n"
+            "   Partitions=compute\n")
+        self.assertEqual({"n0": ["compute", "debug"], "n1": ["compute"]},
+                         reboot.get_node_partitions(["n0", "n1"]))
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(reboot, "list_servers")
+    def test_wait_for_servers(self, mock_list, mock_sleep):
+        mock_list.side_effect = [
+            {"a": server.Server(id="a", status="REBUILD"),
+             "b": server.Server(id="b", status="ERROR")},
+            {"a": server.Server(id="a", status="ACTIVE")},
+        ]
+        self.assertEqual({"a": "ACTIVE", "b": "ERROR", "c": "MISSING"},
+                         reboot.wait_for_servers("conn", ["a", "b", "c"]))
+        self.assertEqual(1, mock_sleep.call_count)
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(reboot, "list_servers")
+    def test_wait_for_servers_timeout(self, mock_list, mock_sleep):
+        mock_list.return_value = {"a": server.Server(id="a", status="REBOOT")}
+        self.assertEqual({"a": "TIMEOUT"},
+                         reboot.wait_for_servers("conn", ["a"], timeout=0))
+
+    @mock.patch.object(reboot, "wait_for_servers")
+    @mock.patch.object(reboot, "process_nodes")
+    @mock.patch.object(reboot, "get_node_partitions", return_value={})
+    def test_rolling_process_nodes(self, mock_partitions, mock_process,
+                                   mock_wait):
+        get_hostvars = self.useFixture(fixtures.MockPatchObject(
+            reboot, "get_hostvars")).mock
+        mock_process.side_effect = fake_process_nodes(
+            {"n0": "rebuild", "n1": "skipped"}, {"n2": "reboot"})
+        mock_wait.side_effect = [{"s0": "ACTIVE"}, {"s2": "ERROR"}]
+        results = reboot.rolling_process_nodes(
+            "conn", ["n0", "n1", "n2"], max_per_group=2)
+        self.assertEqual(0, get_hostvars.call_count)
+        mock_wait.assert_any_call("conn", {"s0": "n0"}, timeout=mock.ANY,
+                                  poll_interval=mock.ANY)
+        self.assertEqual("rebuild", results["n0"])
+        self.assertEqual("skipped", results["n1"])
+        self.assertIsInstance(results["n2"], RuntimeError)
+        self.assertEqual(2, mock_process.call_count)
+
+    @mock.patch.object(reboot, "wait_for_servers")
+    @mock.patch.object(reboot, "process_nodes")
+    @mock.patch.object(reboot, "get_node_partitions", return_value={})
+    def test_rolling_stops_after_failed_wave(self, mock_partitions,
+                                             mock_process, mock_wait):
+        mock_process.side_effect = fake_process_nodes({"n0": "rebuild"})
+        mock_wait.return_value = {"s0": "TIMEOUT"}
+        results = reboot.rolling_process_nodes(
+            "conn", ["n0", "n1", "n2"], max_per_group=1)
+        self.assertIsInstance(results["n0"], RuntimeError)
+        self.assertEqual("not attempted", results["n1"])
+        self.assertEqual("not attempted", results["n2"])
+        self.assertEqual(1, mock_process.call_count)
+        self.assertEqual(1, reboot.summarise(results))
+
+    @mock.patch.object(reboot, "wait_for_servers")
+    @mock.patch.object(reboot, "process_nodes")
+    @mock.patch.object(reboot, "get_node_partitions", return_value={})
+    def test_rolling_max_failures(self, mock_partitions, mock_process,
+                                  mock_wait):
+        mock_process.side_effect = fake_process_nodes(
+            {"n0": "rebuild"}, {"n1": "rebuild"}, {"n2": "rebuild"})
+        mock_wait.side_effect = [
+            {"s0": "ERROR"}, exceptions.HttpException("list failed")]
+        results = reboot.rolling_process_nodes(
+            "conn", ["n0", "n1", "n2"], max_per_group=1, max_failures=1)
+        self.assertIsInstance(results["n0"], RuntimeError)
+        self.assertIsInstance(results["n1"], exceptions.HttpException)
+        self.assertEqual("not attempted", results["n2"])
+        self.assertEqual(2, mock_process.call_count)
+
+
+class TestPrecache(base.BaseTestCase):
+    def test_choose_aggregates(self):
+        aggs = [aggregate.Aggregate(id="1", hosts=["h0"]),
+                aggregate.Aggregate(id="2", hosts=["h0", "h1", "h2"]),
+                aggregate.Aggregate(id="3", hosts=["h3"]),
+                aggregate.Aggregate(id="4", hosts=None)]
+        chosen, uncovered = reboot.choose_aggregates(
+            aggs, {"h0", "h1", "h3", "h9"})
+        self.assertEqual(["2", "3"], [agg.id for agg in chosen])
+        self.assertEqual({"h9"}, uncovered)
+
+    @mock.patch.object(reboot, "list_servers")
+    def test_plan_precache(self, mock_list):
+        self.useFixture(fixtures.MockPatchObject(
+            reboot, "get_hostvars", side_effect=indexed))
+        mock_list.return_value = {
+            "s0": server.Server(id="s0", image={"id": "old"},
+                                compute_host="h0"),
+            "s1": server.Server(id="s1", image={"id": "new"},
+                                compute_host="h1"),
+            "s2": server.Server(id="s2", image={"id": "old"},
+                                compute_host="h2"),
+        }
+        index = {"n0": {"instance_id": "s0", "image_id": "new"},
+                 "n1": {"instance_id": "s1", "image_id": "new"},
+                 "n2": {"instance_id": "s2", "image_id": "other"}}
+        self.assertEqual({"new": {"h0"}, "other": {"h2"}},
+                         reboot.plan_precache("conn", list(index), index))
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(reboot, "plan_precache")
+    def test_precache_images(self, mock_plan, mock_sleep):
+        mock_plan.return_value = {"new": {"h0", "h1"}, "other": {"h1"}}
+        conn = mock.Mock()
+        agg = aggregate.Aggregate(id="1", name="agg", hosts=["h0", "h1"])
+        conn.compute.aggregates.return_value = [agg]
+        self.assertEqual(1, reboot.precache_images(conn, [], wait=10))
+        conn.compute.aggregate_precache_images.assert_called_once_with(
+            agg, ["new", "other"])
+        mock_sleep.assert_called_once_with(10)
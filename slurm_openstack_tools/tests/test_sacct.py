@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import io
+import json
+import os
+import sys
+import time
+from unittest import mock
+
+import fixtures
+from oslotest import base
+
+from slurm_openstack_tools import sacct
+from slurm_openstack_tools.tests import fake_slurm
+
+TITLES = "JobID|JobIDRaw|Cluster|Start|End|NodeList"
+
+
+class StopFollowing(Exception):
+    pass
+
+
+class TestSacct(base.BaseTestCase):
+    def setUp(self):
+        super(TestSacct, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.timestamp_file = os.path.join(self.tmpdir, "lasttimestamp")
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.sacct.TIMESTAMP_FILE",
+            self.timestamp_file))
+        self.state_file = os.path.join(self.tmpdir, "lasttimestamps.json")
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.sacct.CLUSTERS_STATE_FILE",
+            self.state_file))
+        self.stdout = io.StringIO()
+        self.useFixture(fixtures.MonkeyPatch("sys.stdout", self.stdout))
+
+    def output(self):
+        return [json.loads(line)
+                for line in self.stdout.getvalue().splitlines()]
+
+    def test_parse_lines(self):
+        cache = {}
+        items = sacct.parse_lines([
+            TITLES,
+            "1|1|linux|2020-06-23T12:43:21|2020-06-23T12:43:23|c[1-2]",
+            "1.batch|1.batch|linux|2020-06-23T12:43:21|"
+            "2020-06-23T12:43:23|c1",
+            "2|2|linux|None|2020-06-23T12:43:23|c[1-2]",
+            "garbage",
+        ], cache)
+        self.assertEqual(["1", "2"], [item["JobID"] for item in items])
+        self.assertEqual(["c1", "c2"], items[0]["AllNodes"])
+        self.assertEqual("c1|c2", items[0]["AllNodesRegex"])
+        self.assertIn("StartEpoch", items[0])
+        self.assertNotIn("StartEpoch", items[1])
+        self.assertEqual({"c[1-2]": ["c1", "c2"], "c1": ["c1"]}, cache)
+
+    def test_parse_lines_error(self):
+        self.assertIsNone(sacct.parse_lines(["sacct: error", ""]))
+
+    def test_main_with_fake_sacct(self):
+        slurm = fake_slurm.SimulatedSlurm(
+            self.tmpdir, fake_slurm.make_nodes(["c0", "c1"]), sacct_jobs=3)
+        self.useFixture(fixtures.EnvironmentVariable(
+            "PATH", slurm.bindir + os.pathsep + os.environ["PATH"]))
+        with mock.patch.object(sys, "argv", ["slurm-stats"]):
+            sacct.main()
+        items = self.output()
+        self.assertEqual(["1", "2", "3"], [item["JobID"] for item in items])
+        self.assertEqual(["c0"], items[0]["AllNodes"])
+        self.assertTrue(os.path.exists(self.timestamp_file))
+
+    def test_main_with_clusters(self):
+        slurm = fake_slurm.SimulatedSlurm(
+            self.tmpdir, fake_slurm.make_nodes(["c0", "c1"]), sacct_jobs=2)
+        self.useFixture(fixtures.EnvironmentVariable(
+            "PATH", slurm.bindir + os.pathsep + os.environ["PATH"]))
+        argv = ["slurm-stats", "--clusters", "alpha,beta"]
+        with mock.patch.object(sys, "argv", argv):
+            sacct.main()
+        self.assertEqual(
+            [("alpha", "1"), ("alpha", "2"), ("beta", "1"), ("beta", "2")],
+            [(item["Cluster"], item["JobID"]) for item in self.output()])
+        with open(self.state_file) as f:
+            self.assertEqual(["alpha", "beta"], sorted(json.load(f)))
+        self.assertFalse(os.path.exists(self.timestamp_file))
+
+    def test_parse_args_clusters(self):
+        args = sacct.parse_args(["--clusters", "alpha,,beta"])
+        self.assertEqual(["alpha", "beta"], args.clusters)
+        self.useFixture(fixtures.MonkeyPatch("sys.stderr", io.StringIO()))
+        self.assertRaises(SystemExit, sacct.parse_args, ["--clusters", ","])
+        self.assertRaises(SystemExit, sacct.parse_args,
+                          ["--clusters", "alpha", "--follow"])
+        self.assertRaises(SystemExit, sacct.parse_args,
+                          ["--clusters", "alpha", "--occupancy", "60"])
+
+    @mock.patch.object(sacct, "run_sacct")
+    def test_clusters_keep_failed_checkpoint(self, mock_run):
+        with open(self.state_file, "w") as f:
+            json.dump({"alpha": "2020-01-01T00:00:00",
+                       "beta": "2020-01-01T00:00:00"}, f)
+
+        def run_sacct(start_str, end_str, cluster):
+            if cluster == "beta":
+                return ["sacct: error: slurmdbd unavailable"]
+            return [TITLES, "1|1|%s|None|2020-06-23T12:43:23|c1" % cluster, ""]
+        mock_run.side_effect = run_sacct
+
+        self.assertEqual(1, sacct.fetch_clusters(["alpha", "beta"]))
+        self.assertEqual(["alpha"],
+                         [item["Cluster"] for item in self.output()])
+        mock_run.assert_any_call("2020-01-01T00:00:00", mock.ANY, "alpha")
+        with open(self.state_file) as f:
+            starts = json.load(f)
+        self.assertEqual("2020-01-01T00:00:00", starts["beta"])
+        self.assertGreater(starts["alpha"], "2020-01-01T00:00:00")
+
+    @mock.patch.object(sacct.metrics, "write")
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(sacct, "run_sacct")
+    def test_follow_emits_each_job_once(self, mock_run, mock_sleep,
+                                        mock_write):
+        recent = datetime.datetime.utcnow().strftime(sacct.SLURM_DATE_FORMAT)
+        job1 = "1|1|linux|%s|%s|c1" % (recent, recent)
+        job2 = "2|2|linux|%s|%s|c1" % (recent, recent)
+        mock_run.side_effect = [
+            [TITLES, job1, ""],
+            ["sacct: error: slurmdbd unavailable"],
+            [TITLES, job1, job2, ""],
+        ]
+        mock_sleep.side_effect = [None, None, StopFollowing()]
+        self.assertRaises(StopFollowing, sacct.follow, 10, 300)
+        self.assertEqual(["1", "2"],
+                         [item["JobID"] for item in self.output()])
+        start, end = mock_run.call_args_list[2][0]
+        self.assertLess(start, end)
+        with open(self.timestamp_file) as f:
+            self.assertEqual(start, f.read())
+        self.assertEqual(3, mock_write.call_count)
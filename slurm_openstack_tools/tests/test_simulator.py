@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import sys
+from unittest import mock
+
+import fixtures
+import openstack
+from openstack.compute.v2 import server
+from openstack.network.v2 import network
+from openstack.network.v2 import port
+from oslotest import base
+
+from slurm_openstack_tools import resume
+from slurm_openstack_tools import suspend
+from slurm_openstack_tools.tests import benchmark
+from slurm_openstack_tools.tests import fake_slurm
+from slurm_openstack_tools.tests import fakes
+from slurm_openstack_tools import throttle
+
+
+class TestSimulator(base.BaseTestCase):
+    """Run each tool end to end against the simulated cloud and Slurm."""
+
+    def setUp(self):
+        super(TestSimulator, self).setUp()
+        # There is no syslog socket in test environments
+        self.useFixture(fixtures.MockPatchObject(
+            logging.getLogger("syslogger"), "handlers",
+            [logging.NullHandler()]))
+
+    def test_resume(self):
+        stats = benchmark.run("resume", 10)
+        self.assertEqual(10, stats["calls"]["create_server"])
+
+    def test_suspend(self):
+        stats = benchmark.run("suspend", 10)
+        self.assertEqual(10, stats["calls"]["delete_server"])
+
+    def test_rebuild(self):
+        stats = benchmark.run("rebuild", 10)
+        self.assertEqual(5, stats["calls"]["rebuild_server"])
+        self.assertEqual(5, stats["calls"]["reboot_server"])
+        self.assertEqual(1, stats["calls"]["get_image"])
+        self.assertEqual(1, stats["calls"]["list_servers"])
+
+    @mock.patch.object(throttle.time, "sleep")
+    def test_resume_retries_throttling(self, mock_sleep):
+        stats = benchmark.run("resume", 10, error_rate=0.5)
+        self.assertGreater(stats["api_errors"], 0)
+        self.assertEqual(10 + stats["api_errors"],
+                         stats["calls"]["create_server"])
+
+
+class TestResumeOptions(base.BaseTestCase):
+    """Resume and suspend with optional behaviour set in the environment."""
+
+    def setUp(self):
+        super(TestResumeOptions, self).setUp()
+        self.useFixture(fixtures.MockPatchObject(
+            logging.getLogger("syslogger"), "handlers",
+            [logging.NullHandler()]))
+        self.useFixture(fixtures.MockPatchObject(
+            throttle, "_caller", throttle.ApiCaller()))
+        self.workdir = self.useFixture(fixtures.TempDir()).path
+        self.cloud = fakes.FakeCloud()
+        self.nodes = ["compute-%d" % i for i in range(4)]
+
+    def run_tool(self, func, ports="", nodeaddr=""):
+        environ = {"SLURM_OPENSTACK_PORTS": ports,
+                   "SLURM_OPENSTACK_NODEADDR": nodeaddr}
+        with fakes.simulate(self.cloud, self.nodes, self.workdir) as slurm, \
+                mock.patch.dict(os.environ, environ), \
+                mock.patch.object(sys, "argv", ["tool", "compute-[0-3]"]):
+            func()
+        return slurm
+
+    def state(self, node):
+        with open(os.path.join(self.workdir, "statesave", node)) as f:
+            return f.read().split()
+
+    def test_resume_creates_ports_in_bulk(self):
+        self.run_tool(resume.resume, ports="bulk")
+        self.assertEqual(1, self.cloud.calls["create_ports"])
+        self.assertEqual(4, self.cloud.calls["create_server"])
+        for node in self.nodes:
+            server_id, port_id = self.state(node)
+            self.assertEqual(server_id, self.cloud.ports[port_id].device_id)
+            self.assertEqual(node, self.cloud.ports[port_id].name)
+        self.assertEqual(4, len(self.cloud.ports))
+
+        self.run_tool(suspend.suspend, ports="bulk")
+        self.assertEqual(4, self.cloud.calls["delete_port"])
+        self.assertEqual({}, self.cloud.ports)
+
+    def test_resume_reuses_kept_ports(self):
+        self.run_tool(resume.resume, ports="reuse")
+        first = [self.state(node)[1] for node in self.nodes]
+        self.run_tool(suspend.suspend, ports="reuse")
+        self.assertEqual(4, len(self.cloud.ports))
+        self.run_tool(resume.resume, ports="reuse")
+
+        self.assertEqual(1, self.cloud.calls["create_ports"])
+        self.assertEqual(1, self.cloud.calls["list_ports"])
+        self.assertEqual(first, [self.state(node)[1] for node in self.nodes])
+        self.assertEqual(4, len(self.cloud.ports))
+
+    def test_resume_failed_bulk_create_deletes_other_networks_ports(self):
+        self.cloud.networks["other-net"] = network.Network(
+            id="net-other-net", name="other-net")
+        other = [f for f in fake_slurm.DEFAULT_FEATURES
+                 if not f.startswith("network=")] + ["network=other-net"]
+        self.nodes = fake_slurm.make_nodes(["compute-0", "compute-1"])
+        self.nodes.update(fake_slurm.make_nodes(
+            ["compute-2", "compute-3"], other))
+        self.cloud.inject("create_ports", 400, after=1)
+        self.assertRaises(openstack.exceptions.HttpException,
+                          self.run_tool, resume.resume, ports="bulk")
+        self.assertEqual(2, self.cloud.calls["create_ports"])
+        self.assertEqual(0, self.cloud.calls["create_server"])
+        self.assertEqual({}, self.cloud.ports)
+
+    @mock.patch.object(throttle.time, "sleep")
+    def test_resume_does_not_repeat_applied_create(self, mock_sleep):
+        self.cloud.inject("create_server", 503, applied=True)
+        self.cloud.inject("create_ports", 503, applied=True)
+        self.run_tool(resume.resume, ports="bulk")
+        self.assertEqual(4, self.cloud.calls["create_server"])
+        self.assertEqual(4, len(self.cloud.servers))
+        self.assertEqual(1, self.cloud.calls["create_ports"])
+        self.assertEqual(4, len(self.cloud.ports))
+        self.assertIn(self.state("compute-0")[0], self.cloud.servers)
+
+    @mock.patch.object(throttle.time, "sleep")
+    def test_resume_retries_unapplied_create(self, mock_sleep):
+        self.cloud.inject("create_server", 503)
+        self.run_tool(resume.resume)
+        self.assertEqual(5, self.cloud.calls["create_server"])
+        self.assertEqual(4, len(self.cloud.servers))
+
+    def test_resume_failure_deletes_new_ports(self):
+        self.cloud.inject("create_server", 400)
+        self.assertRaises(openstack.exceptions.HttpException,
+                          self.run_tool, resume.resume, ports="bulk")
+        self.assertEqual(1, self.cloud.calls["create_server"])
+        self.assertEqual({}, self.cloud.ports)
+
+    def test_resume_sets_nodeaddrs(self):
+        slurm = self.run_tool(resume.resume, nodeaddr="1")
+        self.assertEqual(1, self.cloud.calls["list_servers"])
+        addresses = dict(
+            (record["name"], self.cloud.ports[record["networks"][0]])
+            for record in self.cloud.servers.values())
+        self.assertEqual([[
+            "nodename=compute-[0-3]",
+            "nodeaddr=" + ",".join(
+                addresses[node].fixed_ips[0]["ip_address"]
+                for node in self.nodes)]], slurm.read_updates())
+
+    def test_resume_nodeaddrs_from_ports(self):
+        slurm = self.run_tool(resume.resume, ports="bulk", nodeaddr="1")
+        self.assertEqual(0, self.cloud.calls["list_servers"])
+        self.assertEqual(1, len(slurm.read_updates()))
+
+    def test_resume_failure_sets_created_nodeaddrs(self):
+        self.cloud.inject("create_server", 400, after=2)
+        self.assertRaises(openstack.exceptions.HttpException,
+                          self.run_tool, resume.resume, nodeaddr="1")
+        with open(os.path.join(self.workdir, "scontrol-updates")) as f:
+            updates = [line.split() for line in f.read().splitlines()]
+        self.assertEqual(1, len(updates))
+        self.assertEqual("nodename=compute-[0-1]", updates[0][0])
+
+    def test_get_port_ip_prefers_ipv4(self):
+        dual_stack = port.Port(fixed_ips=[
+            {"ip_address": "fd00::5"}, {"ip_address": "10.0.0.5"}])
+        self.assertEqual("10.0.0.5", resume.get_port_ip(dual_stack))
+        self.assertIsNone(resume.get_port_ip(
+            port.Port(fixed_ips=[{"ip_address": "fd00::5"}])))
+
+    @mock.patch.object(resume.time, "sleep")
+    @mock.patch.object(resume, "list_servers")
+    def test_wait_for_addresses_stops_on_error(self, mock_list, mock_sleep):
+        mock_list.return_value = [
+            server.Server(id="a", status="ERROR", addresses={}),
+            server.Server(id="b", status="ACTIVE", addresses={"net": [
+                {"addr": "10.0.0.2", "version": 4}]}),
+        ]
+        self.assertEqual({"c2": "10.0.0.2"}, resume.wait_for_addresses(
+            "conn", {"c1": "a", "c2": "b"}))
+        self.assertEqual(0, mock_sleep.call_count)
+
+    @mock.patch.object(resume.metrics, "run")
+    def test_update_nodeaddrs_batches(self, mock_run):
+        mock_run.return_value.returncode = 0
+        resume.update_nodeaddrs(
+            {"c10": "10.0.0.10", "c2": "10.0.0.2", "c1": "10.0.0.1"},
+            batch_size=2)
+        self.assertEqual([
+            ["scontrol", "update", "nodename=c[1-2]",
+             "nodeaddr=10.0.0.1,10.0.0.2"],
+            ["scontrol", "update", "nodename=c10", "nodeaddr=10.0.0.10"],
+        ], [c[0][0] for c in mock_run.call_args_list])
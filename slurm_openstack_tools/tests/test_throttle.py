@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+from unittest import mock
+
+from keystoneauth1 import exceptions as ksa_exceptions
+import openstack
+from oslotest import base
+import requests
+from urllib3 import exceptions as urllib3_exceptions
+
+from slurm_openstack_tools import throttle
+
+
+def http_error(status, message="Error", headers=None, text=""):
+    response = None
+    if headers is not None:
+        response = mock.Mock(status_code=status, headers=headers, text=text)
+    return openstack.exceptions.HttpException(
+        message=message, http_status=status, response=response)
+
+
+def connect_error(cause, kind=ksa_exceptions.ConnectFailure):
+    """Return a keystoneauth error raised while handling cause."""
+    try:
+        try:
+            raise cause
+        except requests.exceptions.RequestException:
+            raise kind("Simulated")
+    except kind as e:
+        return e
+
+
+class TestAdaptiveLimiter(base.BaseTestCase):
+    def test_multiplicative_decrease(self):
+        limiter = throttle.AdaptiveLimiter(16, initial=8)
+        limiter.on_throttle()
+        self.assertEqual(4, limiter.limit)
+        for _ in range(10):
+            limiter.on_throttle()
+        self.assertEqual(1, limiter.limit)
+
+    def test_additive_increase_capped(self):
+        limiter = throttle.AdaptiveLimiter(4, initial=2)
+        limiter.on_success()
+        self.assertEqual(2.5, limiter.limit)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(4, limiter.limit)
+
+
+class TestApiCaller(base.BaseTestCase):
+    def test_classify(self):
+        self.assertEqual('throttle', throttle.classify(http_error(429)))
+        self.assertIsNone(throttle.classify(http_error(409)))
+        self.assertEqual('throttle', throttle.classify(
+            http_error(409, headers={'Retry-After': '5'})))
+        self.assertEqual('throttle', throttle.classify(
+            http_error(409, headers={}, text='{"overLimit": {}}')))
+        self.assertEqual('throttle', throttle.classify(
+            http_error(403, "Quota exceeded for instances")))
+        self.assertEqual('transient', throttle.classify(http_error(503)))
+        self.assertIsNone(throttle.classify(http_error(403, "Forbidden")))
+        self.assertIsNone(throttle.classify(http_error(404)))
+        self.assertIsNone(throttle.classify(ValueError()))
+
+    @mock.patch.object(time, "sleep")
+    def test_retries_throttled_call(self, mock_sleep):
+        caller = throttle.ApiCaller(limits={'op': 8})
+        func = mock.Mock(side_effect=[http_error(429), "result"])
+        self.assertEqual("result", caller.call('op', func, 1, a=2))
+        func.assert_called_with(1, a=2)
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(1, mock_sleep.call_count)
+        self.assertEqual(0, caller.limiter('op').in_flight)
+        self.assertLess(caller.limiter('op').limit, 4)
+
+    @mock.patch.object(time, "sleep")
+    def test_gives_up_after_retries(self, mock_sleep):
+        caller = throttle.ApiCaller(retries=2)
+        func = mock.Mock(side_effect=http_error(503))
+        self.assertRaises(openstack.exceptions.HttpException,
+                          caller.call, 'op', func)
+        self.assertEqual(3, func.call_count)
+
+    @mock.patch.object(time, "sleep")
+    def test_does_not_retry_other_errors(self, mock_sleep):
+        caller = throttle.ApiCaller()
+        func = mock.Mock(side_effect=http_error(404))
+        self.assertRaises(openstack.exceptions.HttpException,
+                          caller.call, 'op', func)
+        self.assertEqual(1, func.call_count)
+        self.assertEqual(0, mock_sleep.call_count)
+
+    @mock.patch.object(time, "sleep")
+    def test_does_not_repeat_sent_creates(self, mock_sleep):
+        caller = throttle.ApiCaller(non_idempotent=('create',))
+        func = mock.Mock(side_effect=http_error(503))
+        self.assertRaises(openstack.exceptions.HttpException,
+                          caller.call, 'create', func)
+        self.assertEqual(1, func.call_count)
+
+        unsent = [
+            connect_error(requests.exceptions.ConnectTimeout(),
+                          ksa_exceptions.ConnectTimeout),
+            connect_error(requests.exceptions.ConnectionError(
+                urllib3_exceptions.MaxRetryError(
+                    None, "/", urllib3_exceptions.NewConnectionError(
+                        None, "refused")))),
+        ]
+        func = mock.Mock(side_effect=[http_error(429)] + unsent + ["server"])
+        self.assertEqual("server", caller.call('create', func))
+        self.assertEqual(4, func.call_count)
+
+        for error in (
+                connect_error(requests.exceptions.ReadTimeout(),
+                              ksa_exceptions.ConnectTimeout),
+                connect_error(requests.exceptions.ConnectionError(
+                    "Connection aborted"))):
+            func = mock.Mock(side_effect=[error, "server"])
+            self.assertRaises(type(error), caller.call, 'create', func)
+            self.assertEqual(1, func.call_count)
+
+    @mock.patch.object(time, "sleep")
+    def test_looks_up_sent_creates(self, mock_sleep):
+        caller = throttle.ApiCaller(non_idempotent=('create',))
+        func = mock.Mock(side_effect=[http_error(503), "server"])
+        lookup = mock.Mock(return_value="found")
+        self.assertEqual("found", caller.call('create', func, lookup=lookup))
+        self.assertEqual(1, func.call_count)
+
+        func = mock.Mock(side_effect=[http_error(503), "server"])
+        lookup = mock.Mock(return_value=None)
+        self.assertEqual("server", caller.call('create', func, lookup=lookup))
+        self.assertEqual(2, func.call_count)
+
+        func = mock.Mock(side_effect=[http_error(503), "server"])
+        lookup = mock.Mock(side_effect=http_error(500))
+        self.assertRaises(openstack.exceptions.HttpException,
+                          caller.call, 'create', func, lookup=lookup)
+        self.assertEqual(1, func.call_count)
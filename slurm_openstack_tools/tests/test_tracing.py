@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import threading
+import time
+
+import fixtures
+from oslotest import base
+
+from slurm_openstack_tools import tracing
+
+
+class TestTracing(base.BaseTestCase):
+    def setUp(self):
+        super(TestTracing, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.trace_file = os.path.join(self.tmpdir, "trace.jsonl")
+        self.useFixture(fixtures.EnvironmentVariable(
+            tracing.TRACE_ENV, self.trace_file))
+        self.useFixture(fixtures.EnvironmentVariable(tracing.PROFILE_ENV))
+        self.useFixture(fixtures.MonkeyPatch(
+            "slurm_openstack_tools.tracing._destination", None))
+        tracing.configure("resume")
+
+    def read_spans(self):
+        with open(self.trace_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_nested_spans(self):
+        with tracing.span("resume", hostlist="n[0-1]") as root:
+            with tracing.span("node", node="n0") as node:
+                self.assertEqual(node.span_id, tracing.current())
+            parent = tracing.current()
+            thread = threading.Thread(target=self._in_thread, args=(parent,))
+            thread.start()
+            thread.join()
+        self.assertIsNone(tracing.current())
+
+        spans = self.read_spans()
+        self.assertEqual(["node", "node", "resume"],
+                         [s["name"] for s in spans])
+        self.assertEqual({tracing.trace_id}, {s["trace"] for s in spans})
+        self.assertEqual(root.span_id, spans[0]["parent"])
+        self.assertEqual(root.span_id, spans[1]["parent"])
+        self.assertEqual("n1", spans[1]["node"])
+        self.assertIsNone(spans[2]["parent"])
+        self.assertEqual("resume", spans[2]["tool"])
+        self.assertEqual("ok", spans[2]["status"])
+
+    def _in_thread(self, parent):
+        with tracing.span("node", parent=parent, node="n1"):
+            pass
+
+    def test_error_span(self):
+        def fail():
+            with tracing.span("create_server"):
+                raise ValueError("boom")
+        self.assertRaises(ValueError, fail)
+        span, = self.read_spans()
+        self.assertEqual("error", span["status"])
+        self.assertEqual("boom", span["error"])
+
+    def test_sampling_profiler(self):
+        profiler = tracing.SamplingProfiler(interval=0.001)
+        profiler.enable()
+        time.sleep(0.05)
+        profiler.disable()
+        path = os.path.join(self.tmpdir, "profile.folded")
+        profiler.dump_stats(path)
+        with open(path) as f:
+            self.assertIn("test_sampling_profiler", f.read())
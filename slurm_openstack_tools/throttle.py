@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Adaptive rate limiting and retries for OpenStack API calls.
+
+All OpenStack calls made by the tools go through `call()`, e.g.:
+
+    server = throttle.call('create_server', conn.compute.create_server, ...)
+
+Each call type (the first argument) has its own concurrency limit. The limit
+grows additively while calls succeed and is cut multiplicatively whenever the
+cloud throttles us (HTTP 429, 413, an over-quota 403, or a 409 with a
+Retry-After header or overLimit body), so bursts run at
+the highest concurrency the cloud tolerates. Throttled and transient failures
+(HTTP 5xx, connection errors) are retried with jittered exponential backoff;
+anything else is raised immediately.
+
+Creating calls are not idempotent: a 5xx, read timeout or dropped
+connection can come back after the resource was made, and retrying would make
+a second one. They are retried straight away only when the request was
+rejected (throttled) or the connection was never made. Otherwise they are
+only retried if the caller passes a `lookup` function and it finds nothing
+the failed call created, e.g.:
+
+    throttle.call('create_server', conn.compute.create_server, name=name,
+                  lookup=lambda: find_new_server(conn, name))
+"""
+
+import logging
+import random
+import threading
+import time
+
+from keystoneauth1 import exceptions as ksa_exceptions
+import openstack
+import requests
+from urllib3 import exceptions as urllib3_exceptions
+
+from slurm_openstack_tools import metrics
+from slurm_openstack_tools import tracing
+
+logger = logging.getLogger("syslogger")
+
+# Responses meaning "slow down": rate limited or over quota while other
+# requests in the burst release resources. A 409 is usually a real conflict
+# (e.g. a duplicate name or the server's task state), so it only counts when
+# the response says it is a rate limit.
+THROTTLE_STATUS = (413, 429)
+# Responses meaning "try again": the service is briefly unavailable.
+TRANSIENT_STATUS = (500, 502, 503, 504)
+
+# Maximum concurrency per call type; anything not listed uses DEFAULT_LIMIT.
+DEFAULT_LIMIT = 16
+CALL_LIMITS = {
+    'create_server': 8,
+    'delete_server': 8,
+    'rebuild_server': 8,
+    'reboot_server': 16,
+    'create_ports': 2,
+}
+
+# Call types which must not be repeated after a transient failure.
+NON_IDEMPOTENT_CALLS = ('create_server', 'create_ports')
+
+
+class AdaptiveLimiter(object):
+    """Additive-increase/multiplicative-decrease concurrency limiter."""
+
+    def __init__(self, maximum, initial=None, minimum=1,
+                 increase=1.0, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(min(maximum, initial or max(minimum, maximum / 2)))
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        """Grow the limit by roughly `increase` per limit's worth of calls."""
+        with self._cond:
+            self.limit = min(self.maximum,
+                             self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+def classify(exc):
+    """Return 'throttle', 'transient' or None for a failed API call."""
+    if isinstance(exc, (ksa_exceptions.ConnectFailure,
+                        ksa_exceptions.ConnectTimeout)):
+        return 'transient'
+    if not isinstance(exc, openstack.exceptions.HttpException):
+        return None
+    status = exc.status_code
+    if status in THROTTLE_STATUS:
+        return 'throttle'
+    if status == 409:
+        if retry_after(exc) is not None or 'overlimit' in _body(exc).lower():
+            return 'throttle'
+        return None
+    if status == 403 and 'quota' in str(exc).lower():
+        return 'throttle'
+    if status in TRANSIENT_STATUS:
+        return 'transient'
+    return None
+
+
+def _body(exc):
+    response = getattr(exc, 'response', None)
+    text = getattr(response, 'text', None)
+    return f"{exc} {text}" if isinstance(text, str) else str(exc)
+
+
+def _request_error(exc):
+    """Return the requests exception keystoneauth translated into exc."""
+    while exc is not None:
+        if isinstance(exc, requests.exceptions.RequestException):
+            return exc
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+def was_sent(exc):
+    """Return False if a failed call certainly never reached the service.
+
+    keystoneauth raises ConnectTimeout for every requests Timeout, and
+    ConnectFailure for every requests ConnectionError, including read
+    timeouts and connections dropped after the request was sent. Only a
+    timeout or failure establishing the connection proves it wasn't.
+    """
+    if not isinstance(exc, (ksa_exceptions.ConnectFailure,
+                            ksa_exceptions.ConnectTimeout)):
+        return True
+    error = _request_error(exc)
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, 'reason', reason)
+        if isinstance(reason, urllib3_exceptions.NewConnectionError):
+            return False
+    return True
+
+
+def retry_after(exc):
+    """Return the server's Retry-After hint in seconds, if any."""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiCaller(object):
+    """Run OpenStack API calls under per-call-type adaptive limits."""
+
+    def __init__(self, limits=None, default_limit=DEFAULT_LIMIT,
+                 retries=6, base_delay=1.0, max_delay=60.0,
+                 non_idempotent=NON_IDEMPOTENT_CALLS):
+        self.limits = dict(CALL_LIMITS if limits is None else limits)
+        self.non_idempotent = frozenset(non_idempotent)
+        self.default_limit = default_limit
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, op):
+        with self._lock:
+            if op not in self._limiters:
+                self._limiters[op] = AdaptiveLimiter(
+                    self.limits.get(op, self.default_limit))
+            return self._limiters[op]
+
+    def backoff(self, attempt, exc):
+        """Full-jitter exponential backoff, honouring Retry-After."""
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = retry_after(exc)
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay
+
+    def call(self, op, func, *args, lookup=None, **kwargs):
+        with tracing.span(op, kind="api") as api_span:
+            return self._call(api_span, op, func, *args, lookup=lookup,
+                              **kwargs)
+
+    def _call(self, api_span, op, func, *args, lookup=None, **kwargs):
+        limiter = self.limiter(op)
+        attempt = 0
+        while True:
+            sent_error = None
+            api_span.set("attempts", attempt + 1)
+            limiter.acquire()
+            started = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                metrics.observe_api_call(op, time.monotonic() - started, False)
+                kind = classify(e)
+                if kind == 'transient' and op in self.non_idempotent:
+                    # The resource may have been created anyway
+                    if was_sent(e):
+                        if lookup is None:
+                            raise
+                        sent_error = e
+                if kind is None or attempt >= self.retries:
+                    raise
+                if kind == 'throttle':
+                    limiter.on_throttle()
+                delay = self.backoff(attempt, e)
+                logger.warning(
+                    f"{op} failed ({kind}: {e}), retry {attempt + 1}/"
+                    f"{self.retries} in {delay:.1f}s, limit now "
+                    f"{int(limiter.limit)}")
+            else:
+                metrics.observe_api_call(op, time.monotonic() - started, True)
+                limiter.on_success()
+                return result
+            finally:
+                limiter.release()
+            time.sleep(delay)
+            if sent_error is not None:
+                try:
+                    existing = lookup()
+                except Exception as lookup_error:
+                    logger.warning(f"Could not check whether {op} succeeded: "
+                                   f"{lookup_error}")
+                    raise sent_error
+                if existing:
+                    logger.info(
+                        f"{op} succeeded despite error: {sent_error}")
+                    return existing
+            attempt += 1
+
+
+# Shared by everything in this process, like the module-level loggers.
+_caller = ApiCaller()
+
+
+def call(op, func, *args, lookup=None, **kwargs):
+    """Call `func(*args, **kwargs)` as API call type `op` with retries.
+
+    For a non-idempotent op, `lookup()` should return whatever a call which
+    failed after being sent created, or None if it created nothing.
+    """
+    return _caller.call(op, func, *args, lookup=lookup, **kwargs)
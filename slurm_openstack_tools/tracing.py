@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Per-invocation trace spans and an opt-in profiler.
+
+Every invocation of a tool gets a trace ID. Work is wrapped in nested spans
+(the invocation, each node, each API call or command) and each finished
+span is emitted as one line of compact JSON:
+
+    {"trace":"3f2a...","span":"9c1b...","parent":"77de...","tool":"resume",
+     "name":"create_server","start":1700000000.123,"ms":812.4,"status":"ok"}
+
+Set SLURM_OPENSTACK_TRACE to "syslog" to log spans to syslog, or to a file
+path to append them to that file. Spans are not emitted otherwise.
+
+Set SLURM_OPENSTACK_PROFILE to a directory to write a profile of the run
+there when the tool exits, named <tool>-<trace ID>. By default this is a
+cProfile dump of the main thread (.prof, for pstats/snakeviz). With
+SLURM_OPENSTACK_PROFILER=sample, all threads are sampled instead and the
+output is collapsed stacks (.folded, for flamegraph.pl/speedscope).
+"""
+
+import atexit
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+TRACE_ENV = "SLURM_OPENSTACK_TRACE"
+PROFILE_ENV = "SLURM_OPENSTACK_PROFILE"
+PROFILER_ENV = "SLURM_OPENSTACK_PROFILER"
+
+# Seconds between stack samples with SLURM_OPENSTACK_PROFILER=sample
+SAMPLE_INTERVAL = 0.005
+
+logger = logging.getLogger("syslogger")
+
+trace_id = uuid.uuid4().hex
+_tool = "unknown"
+_destination = None
+_write_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.time()
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+
+def configure(tool):
+    """Set the tool name and start tracing/profiling as configured."""
+    global _tool, _destination
+    _tool = tool
+    _destination = os.environ.get(TRACE_ENV) or None
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if profile_dir:
+        if os.environ.get(PROFILER_ENV) == "sample":
+            profiler = SamplingProfiler()
+        else:
+            profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(_dump_profile, profiler, profile_dir)
+
+
+def current():
+    """Return the ID of this thread's innermost open span, if any."""
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """Time the enclosed block as a span.
+
+    The parent defaults to the innermost open span in this thread; pass
+    `parent=tracing.current()` from the submitting thread to nest work run
+    on a thread pool.
+    """
+    stack = _local.__dict__.setdefault("stack", [])
+    current_span = Span(name, parent or (stack[-1] if stack else None),
+                        attributes)
+    stack.append(current_span.span_id)
+    status = "ok"
+    try:
+        yield current_span
+    except BaseException as e:
+        status = "error"
+        current_span.set("error", str(e) or type(e).__name__)
+        raise
+    finally:
+        stack.pop()
+        if _destination:
+            _emit(current_span, status)
+
+
+def _emit(finished, status):
+    record = {
+        "trace": trace_id, "span": finished.span_id,
+        "parent": finished.parent, "tool": _tool, "name": finished.name,
+        "start": round(finished.start, 3),
+        "ms": round((time.time() - finished.start) * 1000, 1),
+        "status": status,
+    }
+    record.update(finished.attributes)
+    line = json.dumps(record, separators=(",", ":"), default=str)
+    if _destination == "syslog":
+        logger.info(line)
+        return
+    with _write_lock:
+        with open(_destination, "a") as f:
+            f.write(line + "\n")
+
+
+class SamplingProfiler(object):
+    """Sample every thread's stack periodically, as collapsed stacks."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+
+def _dump_profile(profiler, profile_dir):
+    profiler.disable()
+    suffix = ".folded" if isinstance(profiler, SamplingProfiler) else ".prof"
+    path = os.path.join(profile_dir, "%s-%s%s" % (_tool, trace_id, suffix))
+    profiler.dump_stats(path)
+    logger.info(f"Wrote profile to {path}")